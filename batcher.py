@@ -0,0 +1,118 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+import queue
+import threading
+import functools
+import numpy as np
+from concurrent.futures import Future
+
+class Batcher:
+    def __init__(self, submit, max_batch_size=8, max_delay=0.005, observe=None):
+        self._submit = submit
+        self._observe = observe
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, x, *args):
+        return self.submit(x, *args).result()
+
+    def submit(self, x, *args):
+        future = Future()
+        future.submitted = time.monotonic()
+        self._queue.put((x, args, future))
+        return future
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while not self._closed:
+            pending = self._collect()
+            groups = {}
+            for x, args, future in pending:
+                groups.setdefault((args, x.shape), []).append((x, future))
+            for (args, _), group in groups.items():
+                self._dispatch(group, args)
+
+    def _collect(self):
+        pending = []
+        item = self._queue.get()
+        if item is None:
+            return pending
+        pending.append(item)
+        deadline = time.monotonic() + self._max_delay
+        while len(pending) < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                break
+            pending.append(item)
+        return pending
+
+    def _dispatch(self, group, args):
+        if self._observe:
+            now = time.monotonic()
+            self._observe([now - f.submitted for _, f in group])
+        try:
+            future = self._submit(np.stack([x for x, _ in group]), *args)
+        except Exception as e:
+            for _, f in group:
+                f.set_exception(e)
+            return
+        future.add_done_callback(functools.partial(self._scatter, group))
+
+    @staticmethod
+    def _scatter(group, future):
+        e = future.exception()
+        if e is not None:
+            for _, f in group:
+                f.set_exception(e)
+            return
+        for (_, f), y in zip(group, future.result()):
+            f.set_result(y)
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    def forward(batch):
+        print("forward batch:", batch.shape)
+        return batch * 2
+
+    with ThreadPoolExecutor(1) as worker, ThreadPoolExecutor(16) as executor:
+        batcher = Batcher(functools.partial(worker.submit, forward), max_batch_size=4, max_delay=0.01)
+        shapes = [(3, 4, 4), (3, 4, 6)]
+        results = list(executor.map(lambda i: batcher(np.full(shapes[i % 2], i)), range(16)))
+        batcher.close()
+    print([int(y.max()) for y in results])
@@ -0,0 +1,198 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import multiprocessing
+import numpy as np
+import mxnet as mx
+from dataset import get_batches
+from pix2pix_gan import ResnetGenerator, PatchDiscriminator, GANInitializer, power_iterate
+from image_pool import ImagePool
+from train import bce_loss, train_step
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    mx.random.seed(seed)
+
+def measure(fn, warmup, iterations):
+    for i in range(warmup):
+        fn()
+    mx.nd.waitall()
+    times = []
+    for i in range(iterations):
+        ts = time.time()
+        fn()
+        mx.nd.waitall()
+        times.append(time.time() - ts)
+    return float(np.median(times)), float(np.std(times))
+
+def result(batch_size, resolution, elapsed, **kwargs):
+    median, std = elapsed
+    return dict(kwargs, batch_size=batch_size, resolution=resolution, ms=median * 1000, ms_std=std * 1000, samples_per_sec=batch_size / median)
+
+
+def bench_loader(batch_size, resolution, processes, warmup, iterations):
+    load_size = resolution * 286 // 256
+    dataset = [np.random.randint(0, 256, (load_size, load_size, 3), dtype=np.uint8) for i in range(batch_size * (warmup + iterations))]
+    batches = iter(get_batches(dataset, dataset, batch_size, (resolution, resolution), (load_size, load_size), processes=processes))
+    try:
+        for i in range(warmup):
+            next(batches)
+        ts = time.time()
+        for i in range(iterations):
+            next(batches)[1].wait_to_read()
+        return result(batch_size, resolution, ((time.time() - ts) / iterations, 0.0), processes=processes)
+    finally:
+        if hasattr(batches, "close"):
+            batches.close()
+
+def bench_network(net, batch_size, resolution, backward, context, warmup, iterations):
+    net.initialize(GANInitializer(), ctx=context)
+    power_iterate(net)
+    net.hybridize()
+    x = mx.nd.random.uniform(-1, 1, (batch_size, 3, resolution, resolution), ctx=context)
+
+    def forward_backward():
+        with mx.autograd.record():
+            y, cam_y = net(x)
+            L = bce_loss(y, mx.nd.ones_like(y)) + bce_loss(cam_y, mx.nd.ones_like(cam_y))
+        L.backward()
+
+    def forward():
+        net(x)[0]
+
+    return result(batch_size, resolution, measure(forward_backward if backward else forward, warmup, iterations))
+
+def bench_step(batch_size, resolution, context, warmup, iterations):
+    nets = (ResnetGenerator(lazy_sn=True), ResnetGenerator(lazy_sn=True), PatchDiscriminator(lazy_sn=True), PatchDiscriminator(lazy_sn=True))
+    for net in nets:
+        net.initialize(GANInitializer(), ctx=context)
+        power_iterate(net)
+        net.hybridize()
+    trainers = [mx.gluon.Trainer(net.collect_params(), "Nadam", {
+        "learning_rate": lr,
+        "beta1": 0.5
+    }) for net, lr in zip(nets, (0.0001, 0.0001, 0.0003, 0.0003))]
+    pools = (ImagePool(50), ImagePool(50))
+    real_a = mx.nd.random.uniform(-1, 1, (batch_size, 3, resolution, resolution), ctx=context)
+    real_b = mx.nd.random.uniform(-1, 1, (batch_size, 3, resolution, resolution), ctx=context)
+    return result(batch_size, resolution, measure(lambda: train_step(nets, trainers, pools, real_a, real_b, 10.0, 0.5, [context], batch_size), warmup, iterations))
+
+
+def run(suites, batch_sizes, resolutions, loader_processes, warmup, iterations, seed, context):
+    results = {}
+
+    def record(key, fn, *args):
+        seed_all(seed)
+        results[key] = fn(*args)
+        print("%-48s %10.2f samples/s  %10.2fms +- %.2fms" % (key, results[key]["samples_per_sec"], results[key]["ms"], results[key]["ms_std"]), flush=True)
+
+    for resolution in resolutions:
+        for batch_size in batch_sizes:
+            if "loader" in suites:
+                for processes in loader_processes:
+                    record("loader/p%d/b%d/%d" % (processes, batch_size, resolution), bench_loader, batch_size, resolution, processes, warmup, iterations)
+            if "network" in suites:
+                for name, cls in (("generator", ResnetGenerator), ("discriminator", PatchDiscriminator)):
+                    record("%s/forward/b%d/%d" % (name, batch_size, resolution), bench_network, cls(lazy_sn=True), batch_size, resolution, False, context, warmup, iterations)
+                    record("%s/forward_backward/b%d/%d" % (name, batch_size, resolution), bench_network, cls(lazy_sn=True), batch_size, resolution, True, context, warmup, iterations)
+            if "step" in suites:
+                record("step/b%d/%d" % (batch_size, resolution), bench_step, batch_size, resolution, context, warmup, iterations)
+    return results
+
+def environment(context):
+    features = mx.runtime.Features()
+    return {
+        "mxnet": mx.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "context": str(context),
+        "features": sorted(name for name in ("CUDA", "CUDNN", "MKLDNN", "OPENMP", "BLAS_OPEN", "BLAS_MKL") if features.is_enabled(name))
+    }
+
+def compare(report, baseline, tolerance):
+    for key in ("mxnet", "context", "cpu_count"):
+        if report["environment"][key] != baseline["environment"].get(key):
+            print("Warning: %s differs from the baseline (%s vs %s)" % (key, report["environment"][key], baseline["environment"].get(key)), flush=True)
+    regressions = []
+    for key, res in report["results"].items():
+        if key not in baseline["results"]:
+            continue
+        ratio = res["samples_per_sec"] / baseline["results"][key]["samples_per_sec"]
+        status = "ok"
+        if ratio < 1.0 - tolerance:
+            status = "REGRESSION"
+            regressions.append(key)
+        elif ratio > 1.0 + tolerance:
+            status = "improved"
+        print("%-48s %10.2f samples/s  baseline %10.2f  %+7.1f%%  %s" % (key, res["samples_per_sec"], baseline["results"][key]["samples_per_sec"], (ratio - 1.0) * 100, status), flush=True)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the cycle_gan data loader, networks and training step with synthetic data.")
+    parser.add_argument("--suites", help="set the suites to run (default: loader network step)", type=str, nargs="+", choices=["loader", "network", "step"], default=["loader", "network", "step"])
+    parser.add_argument("--batch_sizes", help="set the batch sizes (default: 1 4)", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--resolutions", help="set the image resolutions (default: 128 256)", type=int, nargs="+", default=[128, 256])
+    parser.add_argument("--loader_processes", help="set the loader worker processes to try, 0 means using threads (default: 0 4)", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--warmup", help="set the number of untimed iterations (default: 2)", type=int, default=2)
+    parser.add_argument("--iterations", help="set the number of timed iterations (default: 10)", type=int, default=10)
+    parser.add_argument("--seed", help="set the random seed (default: 0)", type=int, default=0)
+    parser.add_argument("--output", help="set the path of the JSON report (default: benchmark.json)", type=str, default="benchmark.json")
+    parser.add_argument("--baseline", help="compare against a JSON report saved earlier", type=str)
+    parser.add_argument("--tolerance", help="set the allowed throughput drop against the baseline (default: 0.1)", type=float, default=0.1)
+    parser.add_argument("--device_id", help="select device that the model using (default: 0)", type=int, default=0)
+    parser.add_argument("--gpu", help="using gpu acceleration", action="store_true")
+    args = parser.parse_args()
+
+    if args.gpu:
+        context = mx.gpu(args.device_id)
+    else:
+        context = mx.cpu(args.device_id)
+
+    report = {
+        "environment": environment(context),
+        "config": {
+            "batch_sizes": args.batch_sizes,
+            "resolutions": args.resolutions,
+            "loader_processes": args.loader_processes,
+            "warmup": args.warmup,
+            "iterations": args.iterations,
+            "seed": args.seed
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": run(args.suites, args.batch_sizes, args.resolutions, args.loader_processes, args.warmup, args.iterations, args.seed, context)
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Report saved to %s" % args.output, flush=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,147 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import queue
+import pickle
+import shutil
+import threading
+import mxnet as mx
+
+def _copy(state):
+    if isinstance(state, mx.nd.NDArray):
+        return state.copyto(mx.cpu())
+    if isinstance(state, (tuple, list)):
+        return type(state)(_copy(s) for s in state)
+    if isinstance(state, dict):
+        return {k: _copy(v) for k, v in state.items()}
+    return state
+
+def _updater(trainer):
+    if trainer._update_on_kvstore:
+        return trainer._kvstore._updater
+    return trainer._updaters[0]
+
+def _replace(tmp, path):
+    with open(tmp, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _save_arrays(path, arrays):
+    mx.nd.save(path + ".tmp", arrays)
+    _replace(path + ".tmp", path)
+
+def _save_bytes(path, data):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    _replace(path + ".tmp", path)
+
+def _copy_file(src, path):
+    shutil.copyfile(src, path + ".tmp")
+    _replace(path + ".tmp", path)
+
+
+def load_checkpoint(prefix):
+    try:
+        with open(prefix + ".ckpt", "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class Checkpointer:
+    def __init__(self, prefix, nets, trainers, pools):
+        self._prefix = prefix
+        self._nets = nets
+        self._trainers = trainers
+        self._pools = pools
+        manifest = load_checkpoint(prefix)
+        self._slot = 0 if manifest is None or manifest["path"].endswith("1") else 1
+        self._queue = queue.Queue(1)
+        self._error = None
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def save(self, state, export=None):
+        if self._error is not None:
+            raise self._error
+        snapshot = {
+            "params": {name: {key: param._reduce() for key, param in net._collect_params_with_prefix().items()} for name, net in self._nets.items()},
+            "states": {name: (_copy(_updater(trainer).states), pickle.dumps(_updater(trainer).optimizer)) for name, trainer in self._trainers.items()},
+            "pools": {"%s:%d" % (name, i): img for name, pool in self._pools.items() for i, img in enumerate(pool.get_states())},
+            "state": state,
+            "export": export
+        }
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.start()
+        self._queue.put(snapshot)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._write(snapshot)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, snapshot):
+        path = "%s.ckpt-%d" % (self._prefix, self._slot)
+        os.makedirs(path, exist_ok=True)
+        files = {}
+        for name, params in snapshot["params"].items():
+            files[name + ".params"] = os.path.join(path, name + ".params")
+            _save_arrays(files[name + ".params"], params)
+        for name, (states, optimizer) in snapshot["states"].items():
+            files[name + ".state"] = os.path.join(path, name + ".state")
+            _save_bytes(files[name + ".state"], pickle.dumps((states, pickle.loads(optimizer))))
+        _save_arrays(os.path.join(path, "pools.params"), snapshot["pools"])
+        _save_bytes(self._prefix + ".ckpt", pickle.dumps(dict(snapshot["state"], path=path)))
+        self._slot = 1 - self._slot
+        if snapshot["export"]:
+            for key, dst in snapshot["export"].items():
+                _copy_file(files[key], dst)
+
+    def restore(self, manifest, ctx=mx.cpu()):
+        path = manifest["path"]
+        pool_ctx = ctx[0] if isinstance(ctx, (list, tuple)) else ctx
+        for name, net in self._nets.items():
+            net.load_parameters(os.path.join(path, name + ".params"), ctx=ctx)
+        for name, trainer in self._trainers.items():
+            trainer.load_states(os.path.join(path, name + ".state"))
+        pools = mx.nd.load(os.path.join(path, "pools.params"))
+        for name, pool in self._pools.items():
+            imgs = sorted((int(k.rsplit(":", 1)[1]), v) for k, v in pools.items() if k.rsplit(":", 1)[0] == name)
+            pool.set_states([v for _, v in imgs], pool_ctx)
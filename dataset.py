@@ -18,11 +18,15 @@
 
 import os
 import cv2
+import time
+import queue
 import random
+import threading
 import zipfile
+import collections
+import multiprocessing
 import numpy as np
 import mxnet as mx
-import gluoncv as gcv
 from multiprocessing import cpu_count
 from multiprocessing.dummy import Pool
 
@@ -40,43 +44,301 @@ def load_dataset(name, category):
             if not os.path.exists(data_path):
                 os.makedirs(data_path)
             f.extractall(path=data_path)
-    imgs = [os.path.join(path, f) for path, _, files in os.walk(os.path.join(data_path, name, category)) for f in files]
+    imgs = sorted(os.path.join(path, f) for path, _, files in os.walk(os.path.join(data_path, name, category)) for f in files)
     return imgs
 
-def get_batches(dataset_a, dataset_b, batch_size, fine_size=(256, 256), load_size=(286, 286), ctx=mx.cpu()):
+def shard_path(name, category, load_size):
+    return os.path.join("data", name, "%s.%dx%d.shard" % (category, load_size[0], load_size[1]))
+
+def make_shard(imgs, path, load_size):
+    index = np.zeros((len(imgs), 3), dtype=np.int64)
+    offset = 0
+    with open(path + ".tmp", "wb") as f:
+        for i, img in enumerate(imgs):
+            img = mx.image.resize_short(load_image(img), min(load_size), interp=3).asnumpy()
+            f.write(img.tobytes())
+            index[i] = (offset, img.shape[0], img.shape[1])
+            offset += img.size
+        f.write(index.tobytes())
+        f.write(np.int64(len(imgs)).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class Shard:
+    def __init__(self, path, rows=None):
+        self._path = path
+        self._open()
+        self._rows = np.arange(len(self._index)) if rows is None else rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Shard(self._path, self._rows[i])
+        offset, h, w = self._index[self._rows[i]]
+        return self._data[offset:offset + h * w * 3].reshape((h, w, 3))
+
+    def __getstate__(self):
+        return {"path": self._path, "rows": self._rows}
+
+    def __setstate__(self, state):
+        self._path = state["path"]
+        self._rows = state["rows"]
+        self._open()
+
+    def _open(self):
+        data = np.memmap(self._path, dtype=np.uint8, mode="r")
+        count = int(data[-8:].view(np.int64)[0]) if data.size >= 8 else -1
+        end = data.size - 8 - count * 24
+        if count < 0 or end < 0:
+            raise ValueError("Invalid shard %s" % self._path)
+        index = data[end:-8].view(np.int64).reshape((count, 3))
+        if count > 0 and index[-1, 0] + index[-1, 1] * index[-1, 2] * 3 != end:
+            raise ValueError("Invalid shard %s" % self._path)
+        self._data = data
+        self._index = index
+
+
+def load_shard(name, category, load_size):
+    return Shard(shard_path(name, category, load_size))
+
+def load_training_set(name, category, load_size=(286, 286), shards=False):
+    if shards:
+        try:
+            return load_shard(name, category, load_size)
+        except FileNotFoundError:
+            print("Shard of %s/%s not found, falling back to raw files." % (name, category), flush=True)
+        except ValueError:
+            print("Shard of %s/%s is invalid, run make_shards.py again. Falling back to raw files." % (name, category), flush=True)
+    return load_dataset(name, category)
+
+def shard_dataset(dataset, rank, num_workers):
+    size = len(dataset) // num_workers * num_workers
+    return dataset[rank:size:num_workers]
+
+def get_batches(dataset_a, dataset_b, batch_size, fine_size=(256, 256), load_size=(286, 286), ctx=mx.cpu(), processes=0, start=0):
+    if processes > 0:
+        return _process_batches(dataset_a, dataset_b, batch_size, fine_size, load_size, ctx, processes, start)
+    return _thread_batches(dataset_a, dataset_b, batch_size, fine_size, load_size, ctx, start)
+
+def _thread_batches(dataset_a, dataset_b, batch_size, fine_size, load_size, ctx, start=0):
     batches = max(len(dataset_a), len(dataset_b)) // batch_size
-    sampler_a = Sampler(dataset_a, fine_size, load_size)
-    sampler_b = Sampler(dataset_b, fine_size, load_size)
-    batchify_fn = gcv.data.batchify.Stack()
-    with Pool(cpu_count() * 2) as p:
-        for i in range(batches):
-            start = i * batch_size
-            samples_a = p.map(sampler_a, range(start, start + batch_size))
-            samples_b = p.map(sampler_b, range(start, start + batch_size))
-            batch_a = batchify_fn(samples_a)
-            batch_b = batchify_fn(samples_b)
-            yield batch_a.as_in_context(ctx), batch_b.as_in_context(ctx)
-
-def rotate(image, angle):
+    sampler_a = BatchSampler(dataset_a, fine_size, load_size)
+    sampler_b = BatchSampler(dataset_b, fine_size, load_size)
+    with Pool(cpu_count()) as p:
+        for i in range(start, batches):
+            indices = range(i * batch_size, (i + 1) * batch_size)
+            batch_a = mx.nd.array(sampler_a(indices, p.imap_unordered), ctx=ctx)
+            batch_b = mx.nd.array(sampler_b(indices, p.imap_unordered), ctx=ctx)
+            yield batch_a, batch_b
+
+class Prefetcher:
+    def __init__(self, batches, depth=2):
+        self._batches = batches
+        self._queue = queue.Queue(max(depth, 1))
+        self._stop = threading.Event()
+        self.wait_time = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        while True:
+            ts = time.time()
+            batch, e = self._queue.get()
+            self.wait_time += time.time() - ts
+            if e is not None:
+                raise e
+            if batch is None:
+                return
+            yield batch
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def _run(self):
+        try:
+            for batch in self._batches:
+                if not self._put((batch, None)):
+                    return
+            self._put((None, None))
+        except Exception as e:
+            self._put((None, e))
+        finally:
+            if hasattr(self._batches, "close"):
+                self._batches.close()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def warp(image, out, fine_size, load_size, rng=random):
     h, w = image.shape[:2]
-    mat = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1)
-    return mx.nd.array(cv2.warpAffine(image.asnumpy(), mat, (w, h), flags=random.randint(0, 4)))
+    mat = cv2.getRotationMatrix2D((w / 2, h / 2), rng.uniform(-20, 20), 1)
+    image = cv2.warpAffine(image, mat, (w, h), flags=rng.randint(0, 4)).astype(np.float32)
+    size = min(load_size)
+    if h > w:
+        new_h, new_w = size * h // w, size
+    else:
+        new_h, new_w = size, size * w // h
+    image = cv2.resize(image, (new_w, new_h), interpolation=rng.randint(0, 4))
+    x0 = rng.randint(0, new_w - fine_size[1])
+    y0 = rng.randint(0, new_h - fine_size[0])
+    crop = image[y0:y0 + fine_size[0], x0:x0 + fine_size[1]]
+    out[:] = crop[:, ::-1] if rng.random() < 0.5 else crop
+
+
+def color_distort(pixels, out, brightness_delta=32, contrast_low=0.5, contrast_high=1.5, saturation_low=0.5, saturation_high=1.5, hue_delta=18, rng=random):
+    coef = np.array([0.299, 0.587, 0.114])
+    tyiq = np.array([[0.299, 0.587, 0.114], [0.596, -0.274, -0.321], [0.211, -0.523, 0.311]])
+    ityiq = np.array([[1.0, 0.956, 0.621], [1.0, -0.272, -0.647], [1.0, -1.107, 1.705]])
+    mean = np.array(cv2.mean(pixels)[:3])
+    mat = np.eye(3)
+    bias = np.zeros(3)
+    if rng.random() > 0.5:
+        bias += rng.uniform(-brightness_delta, brightness_delta)
+    ops = ["contrast", "saturation", "hue"] if rng.randint(0, 1) else ["saturation", "hue", "contrast"]
+    for op in ops:
+        if rng.random() <= 0.5:
+            continue
+        if op == "contrast":
+            alpha = rng.uniform(contrast_low, contrast_high)
+            gray = (mean @ mat + bias) @ coef
+            mat = mat * alpha
+            bias = bias * alpha + (1.0 - alpha) * gray
+        elif op == "saturation":
+            alpha = rng.uniform(saturation_low, saturation_high)
+            lin = alpha * np.eye(3) + (1.0 - alpha) * np.outer(coef, np.ones(3))
+            mat = mat @ lin
+            bias = bias @ lin
+        else:
+            alpha = rng.uniform(-hue_delta, hue_delta)
+            u, w = np.cos(alpha * np.pi), np.sin(alpha * np.pi)
+            bt = np.array([[1.0, 0.0, 0.0], [0.0, u, -w], [0.0, w, u]])
+            lin = (ityiq @ bt @ tyiq).T
+            mat = mat @ lin
+            bias = bias @ lin
+    np.matmul((mat / 127.5).T.astype(np.float32), pixels.reshape((-1, 3)).T, out=out.reshape((3, -1)))
+    out += (bias / 127.5 - 1.0).astype(np.float32)[:, None, None]
+    return out
 
 
-class Sampler:
+def sample(img, pixels, out, fine_size, load_size, rng=random):
+    if isinstance(img, str):
+        img = cv2.cvtColor(cv2.imread(img, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    warp(img, pixels, fine_size, load_size, rng)
+    color_distort(pixels, out, rng=rng)
+
+
+class BatchSampler:
     def __init__(self, dataset, fine_size, load_size):
         self._dataset = dataset
         self._fine_size = fine_size
         self._load_size = load_size
+        self._pixels = None
+        self._out = None
+
+    def __call__(self, indices, map_fn=map):
+        n = len(indices)
+        if self._pixels is None or self._pixels.shape[0] != n:
+            self._pixels = np.empty((n, self._fine_size[0], self._fine_size[1], 3), dtype=np.float32)
+            self._out = np.empty((n, 3, self._fine_size[0], self._fine_size[1]), dtype=np.float32)
+        list(map_fn(self._sample, enumerate(indices)))
+        return self._out
+
+    def _sample(self, args):
+        i, idx = args
+        sample(self._dataset[idx % len(self._dataset)], self._pixels[i], self._out[i], self._fine_size, self._load_size)
+
+
+class ProcessLoader:
+    def __init__(self, dataset_a, dataset_b, batch_size, fine_size=(256, 256), load_size=(286, 286), processes=1, slots=3, seed=None):
+        self._datasets = (dataset_a, dataset_b)
+        self._batch_size = batch_size
+        self._slots = slots
+        shape = (slots, 2, batch_size, 3, fine_size[0], fine_size[1])
+        mp_ctx = multiprocessing.get_context("spawn")
+        raw = mp_ctx.RawArray("f", int(np.prod(shape)))
+        self._buf = np.frombuffer(raw, dtype=np.float32).reshape(shape)
+        if seed is None:
+            seed = random.getrandbits(31)
+        self._pool = mp_ctx.Pool(processes, _init_worker, (self._datasets, raw, shape, fine_size, load_size, seed))
+
+    def batches(self, order_a=None, order_b=None, epoch=0, start=0, ctx=mx.cpu()):
+        orders = [range(len(dataset)) if order is None else order for dataset, order in zip(self._datasets, (order_a, order_b))]
+        batches = max(len(order) for order in orders) // self._batch_size
+        pending = collections.deque()
+        try:
+            for i in range(start, batches):
+                while len(pending) < self._slots and i + len(pending) < batches:
+                    k = i + len(pending)
+                    tasks = []
+                    for side, order in enumerate(orders):
+                        for j in range(self._batch_size):
+                            pos = k * self._batch_size + j
+                            tasks.append((k % self._slots, side, j, order[pos % len(order)], epoch, pos))
+                    pending.append(self._pool.map_async(_process_sample, tasks))
+                pending.popleft().get()
+                yield mx.nd.array(self._buf[i % self._slots, 0], ctx=ctx), mx.nd.array(self._buf[i % self._slots, 1], ctx=ctx)
+        finally:
+            for result in pending:
+                result.wait()
+
+    def __enter__(self):
+        return self
 
-    def __call__(self, idx):
-        img = load_image(self._dataset[idx % len(self._dataset)])
-        img = rotate(img, random.uniform(-20, 20))
-        img = mx.image.resize_short(img, min(self._load_size), interp=random.randint(0, 4))
-        img, _ = mx.image.random_crop(img, self._fine_size)
-        img, _ = gcv.data.transforms.image.random_flip(img, px=0.5)
-        img = gcv.data.transforms.experimental.image.random_color_distort(img)
-        return mx.nd.image.normalize(mx.nd.image.to_tensor(img), mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+def _process_batches(dataset_a, dataset_b, batch_size, fine_size, load_size, ctx, processes, start=0):
+    with ProcessLoader(dataset_a, dataset_b, batch_size, fine_size, load_size, processes) as loader:
+        yield from loader.batches(start=start, ctx=ctx)
+
+
+_worker = {}
+
+def _init_worker(datasets, raw, shape, fine_size, load_size, seed):
+    cv2.setNumThreads(1)
+    _worker.update(
+        datasets = datasets,
+        buf = np.frombuffer(raw, dtype=np.float32).reshape(shape),
+        pixels = np.empty((fine_size[0], fine_size[1], 3), dtype=np.float32),
+        fine_size = fine_size,
+        load_size = load_size,
+        seed = seed
+    )
+
+def _process_sample(task):
+    slot, side, j, idx, epoch, pos = task
+    rng = random.Random("%d:%d:%d:%d" % (_worker["seed"], epoch, side, pos))
+    sample(_worker["datasets"][side][idx], _worker["pixels"], _worker["buf"][slot, side, j], _worker["fine_size"], _worker["load_size"], rng)
 
 
 def reconstruct_color(img):
@@ -85,6 +347,25 @@ def reconstruct_color(img):
     return ((img * std + mean).clip(0.0, 1.0) * 255).astype("uint8")
 
 
+def preprocess(buf, size):
+    return resize_short(imdecode(buf), size)
+
+def imdecode(buf):
+    img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Invalid image data")
+    return img
+
+def resize_short(img, size):
+    h, w = img.shape[:2]
+    if h > w:
+        new_h, new_w = size * h // w, size
+    else:
+        new_h, new_w = size, size * w // h
+    img = cv2.cvtColor(cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_CUBIC), cv2.COLOR_BGR2RGB)
+    return img.transpose((2, 0, 1)).astype(np.float32) / 127.5 - 1.0
+
+
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
 
@@ -0,0 +1,60 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import mxnet as mx
+from pix2pix_gan import ResnetGenerator, freeze
+
+def export_generator(model, direction, context):
+    prefix = "model/{}.gen_{}".format(model, direction)
+    net = ResnetGenerator()
+    net.load_parameters(prefix + ".params", ctx=context)
+    freeze(net)
+    sym = mx.sym.Group(list(net(mx.sym.var("data"))))
+    sym.save(prefix + "-symbol.json")
+    arg_names = set(sym.list_arguments())
+    aux_names = set(sym.list_auxiliary_states())
+    params = {}
+    for name, param in net.collect_params().items():
+        if name in arg_names:
+            params["arg:" + name] = param.data(context).as_in_context(mx.cpu())
+        elif name in aux_names:
+            params["aux:" + name] = param.data(context).as_in_context(mx.cpu())
+    mx.nd.save(prefix + "-0000.params", params)
+    return prefix
+
+
+def import_generator(model, direction, context):
+    prefix = "model/{}.gen_{}".format(model, direction)
+    return mx.gluon.SymbolBlock.imports(prefix + "-symbol.json", ["data"], prefix + "-0000.params", ctx=context)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export frozen cycle_gan generators for inference.")
+    parser.add_argument("--model", help="set the model to export (default: vangogh2photo)", type=str, default="vangogh2photo")
+    parser.add_argument("--device_id", help="select device that the model using (default: 0)", type=int, default=0)
+    parser.add_argument("--gpu", help="using gpu acceleration", action="store_true")
+    args = parser.parse_args()
+
+    if args.gpu:
+        context = mx.gpu(args.device_id)
+    else:
+        context = mx.cpu(args.device_id)
+
+    for direction in ("ab", "ba"):
+        print("Exporting", export_generator(args.model, direction, context), flush=True)
@@ -0,0 +1,99 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import io
+import cv2
+import png
+import urllib.parse
+
+formats = {
+    "png": ("image/png", ".png"),
+    "jpeg": ("image/jpeg", ".jpg"),
+    "webp": ("image/webp", ".webp")
+}
+
+def encode(img, fmt="png", quality=90):
+    if fmt == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif fmt == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    ok, buf = cv2.imencode(formats[fmt][1], cv2.cvtColor(img, cv2.COLOR_RGB2BGR), params)
+    if not ok:
+        raise ValueError("Failed to encode image as %s" % fmt)
+    return buf.tobytes()
+
+
+def negotiate(accept, query, quality=90):
+    params = urllib.parse.parse_qs(query.lstrip("?")) if query else {}
+    if "quality" in params:
+        quality = min(max(int(params["quality"][0]), 1), 100)
+    if "format" in params:
+        fmt = params["format"][0].lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if not fmt in formats:
+            raise ValueError("Unsupported format %s" % fmt)
+        return fmt, quality
+    best, best_q = "png", 0.0
+    for item in (accept or "").split(","):
+        fields = item.strip().split(";")
+        mime = fields[0].strip().lower()
+        q = 1.0
+        for field in fields[1:]:
+            k, _, v = field.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        for fmt, (t, _) in formats.items():
+            if mime == t and q > best_q:
+                best, best_q = fmt, q
+    return best, quality
+
+
+def png_encode(img):
+    height = img.shape[0]
+    width = img.shape[1]
+    img = img.reshape((-1, width * 3))
+    f = io.BytesIO()
+    w = png.Writer(width, height, greyscale=False)
+    w.write(f, img)
+    return f.getvalue()
+
+
+if __name__ == "__main__":
+    import time
+    import numpy as np
+
+    for size in (256, 512, 1024):
+        y, x = np.mgrid[0:size, 0:size]
+        img = np.stack([x * 255 // size, y * 255 // size, (x + y) * 255 // (size * 2)], axis=-1)
+        img = (img + np.random.randint(0, 16, img.shape)).clip(0, 255).astype(np.uint8)
+        for name, fn in [
+            ("pypng", png_encode),
+            ("png", lambda img: encode(img, "png")),
+            ("jpeg", lambda img: encode(img, "jpeg")),
+            ("webp", lambda img: encode(img, "webp"))
+        ]:
+            ts = time.time()
+            for i in range(5):
+                buf = fn(img)
+            print("[%dx%d]  %s  bytes %d  elapsed %.2fms" % (size, size, name, len(buf), (time.time() - ts) / 5 * 1000), flush=True)
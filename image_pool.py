@@ -16,34 +16,49 @@
 # along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import random
+import numpy as np
 import mxnet as mx
 
 class ImagePool:
     def __init__(self, size):
         self._size = size
-        if size > 0:
-            self._images = []
+        self._images = []
+        self._count = 0
 
     def query(self, imgs):
         if self._size <= 0:
             return imgs
+        n = imgs.shape[0]
+        fill = min(n, self._size - self._count)
+        swap = np.random.random_sample(n) < 0.5
+        swap[:fill] = False
+        slots = np.random.randint(0, self._size, n)
         ret_imgs = []
-        for i in range(imgs.shape[0]):
+        for i in range(n):
             img = imgs[i].expand_dims(0)
-            if len(self._images) < self._size:
+            if i < fill:
                 self._images.append(img)
                 ret_imgs.append(img)
+            elif swap[i]:
+                ret_imgs.append(self._images[slots[i]])
+                self._images[slots[i]] = img
             else:
-                p = random.random()
-                if p < 0.5:
-                    idx = random.randrange(len(self._images))
-                    ret_imgs.append(self._images[idx])
-                    self._images[idx] = img
-                else:
-                    ret_imgs.append(img)
+                ret_imgs.append(img)
+        self._count += fill
         return mx.nd.concat(*ret_imgs, dim=0)
 
+    def get_states(self):
+        if self._count <= 0:
+            return []
+        return [img.copyto(mx.cpu()) for img in self._images]
+
+    def set_states(self, imgs, ctx=mx.cpu()):
+        if self._size <= 0 or len(imgs) <= 0:
+            return
+        imgs = mx.nd.concat(*imgs, dim=0)[:self._size].as_in_context(ctx)
+        self._count = imgs.shape[0]
+        self._images = [imgs[i].expand_dims(0) for i in range(self._count)]
+
 
 if __name__ == "__main__":
     pool = ImagePool(50)
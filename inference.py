@@ -0,0 +1,410 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import time
+import queue
+import itertools
+import functools
+import threading
+import multiprocessing as mp
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+def load_generator(model, direction, context, exported=False):
+    from export import import_generator
+    from pix2pix_gan import ResnetGenerator, freeze
+    if exported:
+        net = import_generator(model, direction, context)
+    else:
+        net = ResnetGenerator()
+        net.load_parameters("model/{}.gen_{}.params".format(model, direction), ctx=context)
+        freeze(net)
+    net.hybridize()
+    return net
+
+
+def model_path(model, direction, exported=False):
+    if exported:
+        return "model/{}.gen_{}-symbol.json".format(model, direction)
+    return "model/{}.gen_{}.params".format(model, direction)
+
+
+def model_version(model, direction, exported=False):
+    paths = [model_path(model, direction, exported)]
+    if exported:
+        paths.append("model/{}.gen_{}-0000.params".format(model, direction))
+    return ":".join("%d-%d" % (st.st_mtime_ns, st.st_size) for st in (os.stat(path) for path in paths))
+
+
+class ComputeWorker:
+    def __init__(self):
+        self._forwards = deque()
+        self._loads = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        with self._cond:
+            self._forwards.append((future, fn, args))
+            self._cond.notify()
+        return future
+
+    def submit_steps(self, steps):
+        future = Future()
+        with self._cond:
+            self._loads.append((future, steps))
+            self._cond.notify()
+        return future
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._forwards and not self._loads and not self._closed:
+                    self._cond.wait()
+                if self._forwards:
+                    future, fn, args = self._forwards.popleft()
+                    steps = None
+                elif self._loads:
+                    future, steps = self._loads[0]
+                else:
+                    return
+            if steps is None:
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+                continue
+            try:
+                next(steps)
+                continue
+            except StopIteration as stop:
+                result, e = stop.value, None
+            except Exception as ex:
+                result, e = None, ex
+            with self._cond:
+                self._loads.popleft()
+            if e is None:
+                future.set_result(result)
+            else:
+                future.set_exception(e)
+
+
+class ModelRegistry:
+    def __init__(self, context, exported=False, max_bytes=0, warmup=(), worker=None):
+        self._context = context
+        self._exported = exported
+        self._max_bytes = max_bytes
+        self._warmup = warmup
+        self._worker = worker or ComputeWorker()
+        self._bytes = 0
+        self._nets = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+        self.phases = {}
+
+    def get(self, model, direction):
+        return self.load(model, direction).result()
+
+    def load(self, model, direction):
+        key = (model, direction)
+        with self._lock:
+            if key in self._nets:
+                self._nets.move_to_end(key)
+                future = Future()
+                future.set_result(self._nets[key][0])
+                return future
+            future = self._loading.get(key)
+            if future:
+                return future
+            future = self._loading[key] = Future()
+        self._worker.submit_steps(self._load_steps(model, direction)).add_done_callback(functools.partial(self._loaded, key))
+        return future
+
+    def stats(self):
+        with self._lock:
+            return {
+                "resident": len(self._nets),
+                "bytes": self._bytes,
+                "loads": self.loads,
+                "evictions": self.evictions
+            }
+
+    def _load_steps(self, model, direction):
+        import numpy as np
+        ts = time.time()
+        net = load_generator(model, direction, self._context, self._exported)
+        size = sum(param.data(self._context).size * np.dtype(param.dtype).itemsize for param in net.collect_params().values())
+        phases = {"load": time.time() - ts, "warmup": 0.0}
+        for shape in self._warmup:
+            yield
+            ts = time.time()
+            generate(net, self._context, np.zeros(shape, dtype=np.float32))
+            phases["warmup"] += time.time() - ts
+        return net, size, phases
+
+    def _loaded(self, key, future):
+        e = future.exception()
+        if e is not None:
+            with self._lock:
+                loading = self._loading.pop(key)
+            loading.set_exception(e)
+            return
+        net, size, phases = future.result()
+        with self._lock:
+            self._nets[key] = (net, size)
+            self._bytes += size
+            self.loads += 1
+            self.phases[key] = phases
+            while self._bytes > self._max_bytes > 0 and len(self._nets) > 1:
+                _, (_, evicted) = self._nets.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+            loading = self._loading.pop(key)
+        loading.set_result(net)
+
+
+def generate(net, context, batch):
+    import mxnet as mx
+    from dataset import reconstruct_color
+    fake, _ = net(mx.nd.array(batch, ctx=context))
+    return reconstruct_color(fake.transpose((0, 2, 3, 1))).asnumpy()
+
+
+def warmup_shapes(size, aspects, batch_sizes):
+    shapes = []
+    for w, h in aspects:
+        if h > w:
+            new_h, new_w = size * h // w, size
+        else:
+            new_h, new_w = size, size * w // h
+        for n in batch_sizes:
+            if not (n, 3, new_h, new_w) in shapes:
+                shapes.append((n, 3, new_h, new_w))
+    return shapes
+
+
+def _replica(index, model, direction, exported, max_bytes, warmup, cores, tasks, results):
+    os.sched_setaffinity(0, cores)
+    import mxnet as mx
+    context = mx.cpu()
+    worker = ComputeWorker()
+    registry = ModelRegistry(context, exported, max_bytes, warmup, worker)
+    try:
+        registry.get(model, direction)
+    except Exception as e:
+        results.put((-1, (index, e)))
+        return
+    results.put((-1, (index, registry.phases[(model, direction)])))
+
+    def run(job, batch, future):
+        e = future.exception()
+        if e is not None:
+            results.put((job, e))
+            return
+        worker.submit(generate, future.result(), context, batch).add_done_callback(functools.partial(done, job))
+
+    def done(job, future):
+        e = future.exception()
+        results.put((job, future.result() if e is None else e))
+
+    stats = None
+    while True:
+        if registry.stats() != stats:
+            stats = registry.stats()
+            results.put((-2, (index, stats)))
+        try:
+            task = tasks.get(timeout=1.0)
+        except queue.Empty:
+            continue
+        if task is None:
+            break
+        job, batch, model, direction = task
+        future = registry.load(model, direction)
+        if job is not None:
+            future.add_done_callback(functools.partial(run, job, batch))
+    worker.close()
+
+
+class ReplicaPool:
+    def __init__(self, model, direction, exported=False, replicas=1, threads=0, warmup=(), max_bytes=0, check_interval=1.0):
+        self._model = model
+        self._direction = direction
+        self._exported = exported
+        self._threads = threads
+        self._warmup = warmup
+        self._max_bytes = max_bytes
+        self._check_interval = check_interval
+        cores = sorted(os.sched_getaffinity(0))
+        self._shares = [cores[i * len(cores) // replicas:(i + 1) * len(cores) // replicas] or cores for i in range(replicas)]
+        self._mp = mp.get_context("spawn")
+        self._results = self._mp.Queue()
+        self._futures = {}
+        self._owners = {}
+        self._jobs = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._replicas = [None] * replicas
+        self._running = [set() for _ in range(replicas)]
+        self._ready = [False] * replicas
+        self._abandoned = set()
+        self._known = {(model, direction)}
+        self._stats = [{} for _ in range(replicas)]
+        self.respawns = 0
+        self.phases = []
+        self._collector = None
+        for i in range(replicas):
+            self._spawn(i)
+        while len(self.phases) < replicas:
+            try:
+                job, result = self._results.get(timeout=self._check_interval)
+            except queue.Empty:
+                for i, (p, _) in enumerate(self._replicas):
+                    if not self._ready[i] and not p.is_alive():
+                        self.close()
+                        raise RuntimeError("Replica %d exited with code %s while loading" % (i, p.exitcode))
+                continue
+            index, result = result
+            if job == -2:
+                self._stats[index] = result
+                continue
+            if isinstance(result, Exception):
+                self.close()
+                raise result
+            self._ready[index] = True
+            self.phases.append(result)
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, batch, model=None, direction=None):
+        future = Future()
+        with self._lock:
+            alive = [i for i in range(len(self._replicas)) if self._ready[i]]
+            if not alive:
+                raise RuntimeError("No replica is available")
+            index = min(alive, key=lambda i: len(self._running[i]))
+            job = next(self._jobs)
+            self._futures[job] = future
+            self._owners[job] = index
+            self._running[index].add(job)
+            tasks = self._replicas[index][1]
+            key = (model or self._model, direction or self._direction)
+            preload = [self._replicas[i][1] for i in alive if i != index] if not key in self._known else []
+            self._known.add(key)
+        tasks.put((job, batch) + key)
+        for other in preload:
+            other.put((None, None) + key)
+        return future
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for replica in self._stats:
+                for k, v in replica.items():
+                    stats[k] = stats.get(k, 0) + v
+            return stats
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        for _, tasks in self._replicas:
+            tasks.put(None)
+        for p, _ in self._replicas:
+            p.join()
+        self._results.put((None, None))
+        if self._collector:
+            self._collector.join()
+
+    def _spawn(self, index):
+        environ = dict(os.environ)
+        try:
+            os.environ["OMP_NUM_THREADS"] = str(self._threads if self._threads > 0 else len(self._shares[index]))
+            os.environ["MXNET_CPU_WORKER_NTHREADS"] = "1"
+            tasks = self._mp.Queue()
+            p = self._mp.Process(target=_replica, args=(index, self._model, self._direction, self._exported, self._max_bytes, self._warmup, self._shares[index], tasks, self._results), daemon=True)
+            p.start()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        self._replicas[index] = (p, tasks)
+
+    def _check(self):
+        failed = []
+        with self._lock:
+            if self._closed:
+                return
+            for i, (p, _) in enumerate(self._replicas):
+                if p.is_alive() or i in self._abandoned:
+                    continue
+                e = RuntimeError("Replica %d exited with code %s" % (i, p.exitcode))
+                for job in self._running[i]:
+                    failed.append((self._futures.pop(job), e))
+                    del self._owners[job]
+                self._running[i].clear()
+                self._ready[i] = False
+                self._stats[i] = {}
+                self.respawns += 1
+                print("Replica %d exited with code %s, respawning" % (i, p.exitcode), flush=True)
+                self._spawn(i)
+        for future, e in failed:
+            future.set_exception(e)
+
+    def _collect(self):
+        deadline = time.monotonic() + self._check_interval
+        while True:
+            if time.monotonic() >= deadline:
+                self._check()
+                deadline = time.monotonic() + self._check_interval
+            try:
+                job, result = self._results.get(timeout=self._check_interval)
+            except queue.Empty:
+                continue
+            if job is None:
+                break
+            if job < 0:
+                index, result = result
+                with self._lock:
+                    if job == -2:
+                        self._stats[index] = result
+                    elif isinstance(result, Exception):
+                        self._abandoned.add(index)
+                    else:
+                        self._ready[index] = True
+                if job == -1 and isinstance(result, Exception):
+                    print("Replica %d failed to load: %s" % (index, result), flush=True)
+                continue
+            with self._lock:
+                future = self._futures.pop(job, None)
+                if future is None:
+                    continue
+                self._running[self._owners.pop(job)].discard(job)
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,67 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+import signal
+import argparse
+import subprocess
+
+def launch(command, workers, servers, port):
+    env = dict(os.environ, **{
+        "DMLC_PS_ROOT_URI": "127.0.0.1",
+        "DMLC_PS_ROOT_PORT": str(port),
+        "DMLC_NUM_WORKER": str(workers),
+        "DMLC_NUM_SERVER": str(servers)
+    })
+    roles = ["scheduler"] + ["server"] * servers + ["worker"] * workers
+    procs = [subprocess.Popen(command, env=dict(env, DMLC_ROLE=role)) for role in roles]
+    worker_procs = procs[1 + servers:]
+    try:
+        while True:
+            codes = [p.poll() for p in worker_procs]
+            if any(codes) or None not in codes:
+                break
+            time.sleep(1)
+        if not any(codes):
+            for p in procs[:1 + servers]:
+                p.wait()
+    except KeyboardInterrupt:
+        codes = [1]
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.send_signal(signal.SIGTERM)
+        for p in procs:
+            p.wait()
+    return next((code for code in codes if code), 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Launch a distributed cycle_gan job (scheduler, servers and workers) on the local machine.")
+    parser.add_argument("--workers", help="set the number of worker processes (default: 2)", type=int, default=2)
+    parser.add_argument("--servers", help="set the number of server processes (default: 1)", type=int, default=1)
+    parser.add_argument("--port", help="set the port of the scheduler (default: 9091)", type=int, default=9091)
+    parser.add_argument("command", help="the command run by every process, e.g. python3 train.py --kvstore dist_sync", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    if not args.command:
+        parser.error("a command is required")
+
+    sys.exit(launch(args.command, args.workers, args.servers, args.port))
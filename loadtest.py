@@ -0,0 +1,250 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import argparse
+import http.client
+import urllib.parse
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+def make_model(workdir, model):
+    import mxnet as mx
+    from pix2pix_gan import ResnetGenerator, GANInitializer
+    os.makedirs(os.path.join(workdir, "model"), exist_ok=True)
+    for direction in ("ab", "ba"):
+        net = ResnetGenerator()
+        net.initialize(GANInitializer())
+        net(mx.nd.zeros((1, 3, 64, 64)))
+        net.save_parameters(os.path.join(workdir, "model", "{}.gen_{}.params".format(model, direction)))
+
+def make_images(sizes, variants, seed):
+    rs = np.random.RandomState(seed)
+    images = []
+    for w, h in sizes:
+        for i in range(variants):
+            y, x = np.mgrid[0:h, 0:w]
+            img = np.stack([x * 255 // w, y * 255 // h, (x + y) * 255 // (w + h)], axis=-1) + rs.randint(0, 32, (h, w, 3))
+            ok, buf = cv2.imencode(".jpg", img.clip(0, 255).astype(np.uint8))
+            images.append(("%dx%d" % (w, h), buf.tobytes()))
+    return images
+
+def start_server(workdir, model, port, server_args):
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"), "--model", model, "--addr", "127.0.0.1", "--port", str(port)] + server_args
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    server = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    server.log = log.name
+    return server
+
+def wait_server(server, host, port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server and server.poll() is not None:
+            raise RuntimeError("server exited with code %d, see %s" % (server.returncode, server.log))
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            conn.request("GET", "/ready")
+            status = conn.getresponse().status
+            conn.close()
+            if status != http.HTTPStatus.SERVICE_UNAVAILABLE:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server was not ready in %ds" % timeout)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def post(host, port, path, data, accept, timeout):
+    boundary = "----cycle-gan-loadtest-%x" % threading.get_ident()
+    body = b"".join([
+        ("--%s\r\n" % boundary).encode(),
+        b"Content-Disposition: form-data; name=\"real\"; filename=\"real.jpg\"\r\n",
+        b"Content-Type: image/jpeg\r\n\r\n",
+        data,
+        ("\r\n--%s--\r\n" % boundary).encode()
+    ])
+    headers = {"Content-Type": "multipart/form-data; boundary=" + boundary}
+    if accept:
+        headers["Accept"] = accept
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request("POST", path, body, headers)
+        res = conn.getresponse()
+        return res.status, len(res.read())
+    finally:
+        conn.close()
+
+def run(host, port, path, images, rate, concurrency, duration, accept, timeout, seed):
+    rs = np.random.RandomState(seed)
+    records = []
+    lock = threading.Lock()
+
+    def request(scheduled, label, data):
+        try:
+            status, size = post(host, port, path, data, accept, timeout)
+            error = None if status == 200 else "HTTP %d" % status
+        except Exception as e:
+            size, error = 0, type(e).__name__
+        with lock:
+            records.append((label, scheduled, time.time() - scheduled, size, error))
+
+    ts = time.time()
+    with ThreadPoolExecutor(concurrency) as pool:
+        if rate > 0:
+            i = 0
+            while True:
+                scheduled = ts + rs.exponential(1.0 / rate) if i == 0 else scheduled + rs.exponential(1.0 / rate)
+                if scheduled - ts >= duration:
+                    break
+                time.sleep(max(scheduled - time.time(), 0))
+                label, data = images[rs.randint(len(images))]
+                pool.submit(request, scheduled, label, data)
+                i += 1
+        else:
+            def closed_loop(k):
+                worker_rs = np.random.RandomState(seed + k)
+                while time.time() - ts < duration:
+                    label, data = images[worker_rs.randint(len(images))]
+                    request(time.time(), label, data)
+            for k in range(concurrency):
+                pool.submit(closed_loop, k)
+    return records, time.time() - ts
+
+def summarize(records, elapsed):
+    ok = [r for r in records if r[4] is None]
+    latencies = np.array([r[2] for r in ok]) * 1000
+    errors = {}
+    for r in records:
+        if r[4] is not None:
+            errors[r[4]] = errors.get(r[4], 0) + 1
+    return {
+        "requests": len(records),
+        "succeeded": len(ok),
+        "error_rate": (len(records) - len(ok)) / max(len(records), 1),
+        "errors": errors,
+        "throughput": len(ok) / elapsed,
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max())
+        } if ok else dict.fromkeys(("mean", "p50", "p95", "p99", "max")),
+        "response_bytes": int(sum(r[3] for r in ok))
+    }
+
+def report(records, elapsed):
+    result = summarize(records, elapsed)
+    result["by_size"] = {label: summarize([r for r in records if r[0] == label], elapsed) for label in sorted(set(r[0] for r in records))}
+    return result
+
+def print_report(result):
+    print("%-12s %8s %8s %8s %10s %10s %10s %10s %10s" % ("size", "requests", "errors", "req/s", "mean ms", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for label, res in [("all", result)] + list(result["by_size"].items()):
+        lat = ["%10s" % "-" if res["latency_ms"][k] is None else "%10.1f" % res["latency_ms"][k] for k in ("mean", "p50", "p95", "p99", "max")]
+        print("%-12s %8d %7.2f%% %8.2f %s" % (label, res["requests"], res["error_rate"] * 100, res["throughput"], " ".join(lat)))
+    for error, count in result["errors"].items():
+        print("  %s: %d" % (error, count))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a cycle_gan server started locally with a randomly initialized or existing model.", epilog="Arguments after -- are passed to server.py, e.g. -- --max_batch_size 16 --replicas 2")
+    parser.add_argument("--model", help="set the model loaded by the server, randomly initialized weights are used if omitted", type=str, default=None)
+    parser.add_argument("--url", help="load test a running server instead of starting one, e.g. http://127.0.0.1:80", type=str, default=None)
+    parser.add_argument("--path", help="set the path requested, e.g. /cycle_gan/MODEL/DIRECTION/fake (default: /cycle_gan/fake)", type=str, default="/cycle_gan/fake")
+    parser.add_argument("--rate", help="set the open-loop arrival rate in requests per second, 0 means closed loop (default: 0)", type=float, default=0)
+    parser.add_argument("--concurrency", help="set the max number of requests in flight (default: 8)", type=int, default=8)
+    parser.add_argument("--duration", help="set the duration of the test in seconds (default: 30)", type=float, default=30)
+    parser.add_argument("--warmup", help="set the number of requests sent before measuring (default: 4)", type=int, default=4)
+    parser.add_argument("--image_sizes", help="set the sizes of the posted images (default: 256x256 512x384)", type=str, nargs="+", default=["256x256", "512x384"])
+    parser.add_argument("--accept", help="set the Accept header of requests (default: none)", type=str, default=None)
+    parser.add_argument("--timeout", help="set the timeout in seconds of each request (default: 60)", type=float, default=60)
+    parser.add_argument("--seed", help="set the random seed (default: 0)", type=int, default=0)
+    parser.add_argument("--output", help="save the report as JSON", type=str, default=None)
+    parser.add_argument("server_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    server_args = args.server_args[1:] if args.server_args[:1] == ["--"] else args.server_args
+    images = make_images([tuple(int(v) for v in size.split("x")) for size in args.image_sizes], 4, args.seed)
+
+    server = None
+    workdir = None
+    try:
+        if args.url:
+            url = urllib.parse.urlparse(args.url)
+            host, port = url.hostname, url.port or 80
+        else:
+            host, port = "127.0.0.1", free_port()
+            if args.model:
+                workdir = os.getcwd()
+                model = args.model
+            else:
+                workdir = tempfile.mkdtemp(prefix="cycle_gan_loadtest_")
+                model = "loadtest"
+                print("Initializing random model in %s..." % workdir, flush=True)
+                make_model(workdir, model)
+            print("Starting server...", flush=True)
+            server = start_server(workdir, model, port, server_args)
+        wait_server(server, host, port, 300)
+
+        for i in range(args.warmup):
+            try:
+                status, _ = post(host, port, args.path, images[i % len(images)][1], args.accept, args.timeout)
+                if status != 200:
+                    print("Warm-up request failed: HTTP %d" % status, flush=True)
+            except Exception as e:
+                print("Warm-up request failed: %s" % type(e).__name__, flush=True)
+
+        print("Load testing for %.0fs..." % args.duration, flush=True)
+        records, elapsed = run(host, port, args.path, images, args.rate, args.concurrency, args.duration, args.accept, args.timeout, args.seed)
+        result = report(records, elapsed)
+        result["config"] = {
+            "path": args.path,
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "image_sizes": args.image_sizes,
+            "accept": args.accept,
+            "server_args": server_args
+        }
+        print_report(result)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        if workdir and not args.model and not args.url:
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,36 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+import argparse
+from dataset import load_dataset, shard_path, make_shard
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-decode a cycle_gan dataset into memory-mapped shards.")
+    parser.add_argument("--dataset", help="set the dataset to convert (default: vangogh2photo)", type=str, default="vangogh2photo")
+    parser.add_argument("--categories", help="set the categories to convert (default: trainA trainB)", type=str, nargs="+", default=["trainA", "trainB"])
+    parser.add_argument("--load_size", help="set the load size of images (default: 286)", type=int, default=286)
+    args = parser.parse_args()
+
+    load_size = (args.load_size, args.load_size)
+    for category in args.categories:
+        ts = time.time()
+        imgs = load_dataset(args.dataset, category)
+        path = shard_path(args.dataset, category, load_size)
+        make_shard(imgs, path, load_size)
+        print("%s: %d images  duration %.2fs" % (path, len(imgs), time.time() - ts), flush=True)
@@ -0,0 +1,226 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import json
+import time
+import bisect
+import functools
+import resource
+import threading
+import contextlib
+import mxnet as mx
+
+class PhaseTimer:
+    def __init__(self, domain=None):
+        self.domain = domain
+        self.phases = {}
+        self._phase = None
+        self._task = None
+        self._ts = time.time()
+
+    def __call__(self, phase=None):
+        mx.nd.waitall()
+        now = time.time()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._ts
+        if self._task is not None:
+            self._task.stop()
+            self._task = None
+        self._phase, self._ts = phase, now
+        if phase is not None and self.domain is not None:
+            self._task = mx.profiler.Task(self.domain, phase)
+            self._task.start()
+
+    def reset(self):
+        self(None)
+        phases, self.phases = self.phases, {}
+        return phases
+
+
+class MetricsLogger:
+    def __init__(self, path):
+        self._file = open(path, "a") if path else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, record):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def memory_usage(context):
+    with open("/proc/self/statm") as f:
+        rss = int(f.read().split()[1])
+    usage = {
+        "rss_mb": os.sysconf("SC_PAGE_SIZE") * rss / 2 ** 20,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    }
+    for ctx in context:
+        if ctx.device_type == "gpu":
+            free, total = mx.context.gpu_memory_info(ctx.device_id)
+            usage["gpu%d_used_mb" % ctx.device_id] = (total - free) / 2 ** 20
+    return usage
+
+
+def _format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v))
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in zip(names, values)) + "}"
+
+
+class _Value:
+    def __init__(self, fn=None):
+        self._lock = threading.Lock()
+        self._value = 0.0
+        self._fn = fn
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def get(self):
+        if self._fn is not None:
+            return self._fn()
+        return self._value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.get())]
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        ts = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - ts)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        samples = []
+        acc = 0
+        for le, count in zip(self._buckets + [float("inf")], counts):
+            acc += count
+            samples.append((name + "_bucket", labels + [("le", _format_value(le))], acc))
+        samples.append((name + "_sum", labels, total))
+        samples.append((name + "_count", labels, acc))
+        return samples
+
+
+class Metric:
+    def __init__(self, kind, name, documentation, labels=(), child=_Value):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self._label_names = tuple(labels)
+        self._child = child
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._child()
+        return child
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.labels(), attr)
+
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            for name, labels, value in child.samples(self.name, list(zip(self._label_names, values))):
+                lines.append("%s%s %s" % (name, _format_labels([k for k, _ in labels], [v for _, v in labels]), _format_value(value)))
+        return lines
+
+
+def Counter(name, documentation, labels=()):
+    return Metric("counter", name, documentation, labels)
+
+def Gauge(name, documentation, labels=(), fn=None):
+    metric = Metric("gauge", name, documentation, labels, functools.partial(_Value, fn))
+    if fn is not None:
+        metric.labels()
+    return metric
+
+def Histogram(name, documentation, buckets, labels=()):
+    return Metric("histogram", name, documentation, labels, functools.partial(_Histogram, sorted(buckets)))
+
+
+class Registry:
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return ("\n".join(lines) + "\n").encode()
@@ -18,22 +18,55 @@
 
 import mxnet as mx
 
-class SNConv2D(mx.gluon.nn.Block):
-    def __init__(self, channels, kernel_size, strides, padding, in_channels, epsilon=1e-8, **kwargs):
+class SNUpdate(mx.operator.CustomOp):
+    def forward(self, is_train, req, in_data, out_data, aux):
+        aux[0][:] = in_data[1]
+        self.assign(out_data[0], req[0], in_data[0])
+
+    def backward(self, req, out_grad, in_data, out_data, in_grad, aux):
+        self.assign(in_grad[0], req[0], out_grad[0])
+        self.assign(in_grad[1], req[1], mx.nd.zeros_like(in_data[1]))
+
+
+@mx.operator.register("sn_update")
+class SNUpdateProp(mx.operator.CustomOpProp):
+    def __init__(self):
+        super(SNUpdateProp, self).__init__(need_top_grad=True)
+
+    def list_arguments(self):
+        return ["sigma", "u"]
+
+    def list_outputs(self):
+        return ["output"]
+
+    def list_auxiliary_states(self):
+        return ["state"]
+
+    def infer_shape(self, in_shape):
+        return in_shape, [in_shape[0]], [in_shape[1]]
+
+    def create_operator(self, ctx, shapes, dtypes):
+        return SNUpdate()
+
+
+class SNConv2D(mx.gluon.nn.HybridBlock):
+    def __init__(self, channels, kernel_size, strides, padding, in_channels, epsilon=1e-8, lazy=False, **kwargs):
         super(SNConv2D, self).__init__(**kwargs)
         self._channels = channels
         self._kernel_size = kernel_size
         self._strides = strides
         self._padding = padding
         self._epsilon = epsilon
+        self._lazy = lazy
+        self._frozen = False
         with self.name_scope():
             self._weight = self.params.get("weight", shape=(channels, in_channels, kernel_size, kernel_size))
-            self._u = self.params.get("u", init=mx.init.Normal(), shape=(1, channels))
+            self._u = self.params.get("u", init=mx.init.Normal(), shape=(1, channels), grad_req="null", differentiable=False)
 
-    def forward(self, x):
-        return mx.nd.Convolution(
+    def hybrid_forward(self, F, x, _weight, _u):
+        return F.Convolution(
             data = x,
-            weight = self._spectral_norm(x.context),
+            weight = _weight if self._frozen else self._spectral_norm(F, _weight, _u),
             kernel = (self._kernel_size, self._kernel_size),
             stride = (self._strides, self._strides),
             pad = (self._padding, self._padding),
@@ -41,46 +74,68 @@ class SNConv2D(mx.gluon.nn.Block):
             no_bias = True
         )
 
-    def _spectral_norm(self, ctx):
-        w = self._weight.data(ctx)
-        w_mat = w.reshape((w.shape[0], -1))
-        v = mx.nd.L2Normalization(mx.nd.dot(self._u.data(ctx), w_mat))
-        u = mx.nd.L2Normalization(mx.nd.dot(v, w_mat.T))
-        sigma = mx.nd.sum(mx.nd.dot(u, w_mat) * v)
-        if sigma < self._epsilon:
-            sigma = self._epsilon
+    def power_iterate(self):
+        ctx = self._weight.list_ctx()[0]
+        with mx.autograd.pause():
+            w_mat = self._weight.data(ctx).reshape((self._channels, -1))
+            v = mx.nd.L2Normalization(mx.nd.dot(self._u.data(ctx), w_mat))
+            u = mx.nd.L2Normalization(mx.nd.dot(v, w_mat, transpose_b=True))
+            for arr in self._u.list_data():
+                arr[:] = u
+
+    def freeze(self):
+        if self._frozen:
+            return
+        ctx = self._weight.list_ctx()[0]
         with mx.autograd.pause():
-            self._u.set_data(u)
-        return w / sigma
+            w = self._weight.data(ctx)
+            w_mat = w.reshape((self._channels, -1))
+            v = mx.nd.L2Normalization(mx.nd.dot(self._u.data(ctx), w_mat))
+            u = mx.nd.L2Normalization(mx.nd.dot(v, w_mat, transpose_b=True))
+            sigma = mx.nd.maximum(mx.nd.sum(mx.nd.dot(u, w_mat) * v), self._epsilon)
+            self._weight.set_data(mx.nd.broadcast_div(w, sigma.reshape((1, 1, 1, 1))))
+        self._frozen = True
+
+    def _spectral_norm(self, F, w, u):
+        w_mat = F.reshape(w, shape=(0, -1))
+        if self._lazy:
+            sigma = F.norm(F.dot(u, w_mat))
+        else:
+            v = F.L2Normalization(F.dot(u, w_mat))
+            u_new = F.L2Normalization(F.dot(v, w_mat, transpose_b=True))
+            sigma = F.sum(F.dot(u_new, w_mat) * v)
+            sigma = F.Custom(sigma, u_new, u, op_type="sn_update")
+        sigma = F.maximum(sigma, self._epsilon)
+        return F.broadcast_div(w, F.reshape(sigma, shape=(1, 1, 1, 1)))
 
 
-class ResBlock(mx.gluon.nn.Block):
-    def __init__(self, filters, **kwargs):
+class ResBlock(mx.gluon.nn.HybridBlock):
+    def __init__(self, filters, lazy_sn=False, **kwargs):
         super(ResBlock, self).__init__(**kwargs)
-        self._net = mx.gluon.nn.Sequential()
+        self._net = mx.gluon.nn.HybridSequential()
         with self.name_scope():
             self._net.add(
                 mx.gluon.nn.ReflectionPad2D(1),
-                SNConv2D(filters, 3, 1, 0, filters),
+                SNConv2D(filters, 3, 1, 0, filters, lazy=lazy_sn),
                 mx.gluon.nn.Activation("relu"),
                 mx.gluon.nn.ReflectionPad2D(1),
-                SNConv2D(filters, 3, 1, 0, filters)
+                SNConv2D(filters, 3, 1, 0, filters, lazy=lazy_sn)
             )
 
-    def forward(self, x):
+    def hybrid_forward(self, F, x):
         return self._net(x) + x
 
 
-class UpSampling(mx.gluon.nn.Block):
+class UpSampling(mx.gluon.nn.HybridBlock):
     def __init__(self, scale=2, **kwargs):
         super(UpSampling, self).__init__(**kwargs)
         self._scale = scale
 
-    def forward(self, x):
-        return mx.nd.UpSampling(x, scale=self._scale, sample_type='nearest')
+    def hybrid_forward(self, F, x):
+        return F.UpSampling(x, scale=self._scale, sample_type='nearest')
 
 
-class ClassActivationMapping(mx.gluon.nn.Block):
+class ClassActivationMapping(mx.gluon.nn.HybridBlock):
     def __init__(self, units, activation, **kwargs):
         super(ClassActivationMapping, self).__init__(**kwargs)
         self._act = activation
@@ -91,78 +146,92 @@ class ClassActivationMapping(mx.gluon.nn.Block):
             self._gmp_linear = mx.gluon.nn.Conv2D(units, 1, use_bias=False)
             self._out = mx.gluon.nn.Conv2D(units, 1)
 
-    def forward(self, x):
+    def hybrid_forward(self, F, x):
         gap_y = self._gap_linear(self._gap(x))
         gap_m = self._gap_linear(x)
         gmp_y = self._gmp_linear(self._gmp(x))
         gmp_m = self._gmp_linear(x)
-        return self._act(self._out(mx.nd.concat(gap_m, gmp_m, dim=1))), mx.nd.concat(gap_y, gmp_y, dim=1)
+        return self._act(self._out(F.concat(gap_m, gmp_m, dim=1))), F.concat(gap_y, gmp_y, dim=1)
 
 
-class ResnetGenerator(mx.gluon.nn.Block):
-    def __init__(self, channels=3, filters=64, res_blocks=9, downsample_layers=2, **kwargs):
+class ResnetGenerator(mx.gluon.nn.HybridBlock):
+    def __init__(self, channels=3, filters=64, res_blocks=9, downsample_layers=2, lazy_sn=False, **kwargs):
         super(ResnetGenerator, self).__init__(**kwargs)
-        self._enc = mx.gluon.nn.Sequential()
-        self._dec = mx.gluon.nn.Sequential()
+        self._enc = mx.gluon.nn.HybridSequential()
+        self._dec = mx.gluon.nn.HybridSequential()
         with self.name_scope():
             self._enc.add(
                 mx.gluon.nn.ReflectionPad2D(3),
-                SNConv2D(filters, 7, 1, 0, channels),
+                SNConv2D(filters, 7, 1, 0, channels, lazy=lazy_sn),
                 mx.gluon.nn.Activation("relu")
             )
             for i in range(downsample_layers):
                 self._enc.add(
-                    SNConv2D(2 ** (i + 1) * filters, 3, 2, 1, 2 ** i * filters),
+                    SNConv2D(2 ** (i + 1) * filters, 3, 2, 1, 2 ** i * filters, lazy=lazy_sn),
                     mx.gluon.nn.Activation("relu")
                 )
             units = 2 ** downsample_layers * filters
             for i in range(res_blocks):
-                self._enc.add(ResBlock(units))
+                self._enc.add(ResBlock(units, lazy_sn=lazy_sn))
             self._cam = ClassActivationMapping(units, mx.gluon.nn.Activation("relu"))
             for i in range(downsample_layers):
                 self._dec.add(
                     UpSampling(),
-                    SNConv2D(2 ** (downsample_layers - i - 1) * filters, 3, 1, 1, 2 ** (downsample_layers - i) * filters),
+                    SNConv2D(2 ** (downsample_layers - i - 1) * filters, 3, 1, 1, 2 ** (downsample_layers - i) * filters, lazy=lazy_sn),
                     mx.gluon.nn.Activation("relu")
                 )
             self._dec.add(
                 mx.gluon.nn.ReflectionPad2D(3),
-                SNConv2D(channels, 7, 1, 0, filters),
+                SNConv2D(channels, 7, 1, 0, filters, lazy=lazy_sn),
                 mx.gluon.nn.Activation("tanh")
             )
 
-    def forward(self, x):
+    def hybrid_forward(self, F, x):
         x, y = self._cam(self._enc(x))
         return self._dec(x), y
 
 
-class PatchDiscriminator(mx.gluon.nn.Block):
-    def __init__(self, channels=3, filters=64, layers=3, **kwargs):
+class PatchDiscriminator(mx.gluon.nn.HybridBlock):
+    def __init__(self, channels=3, filters=64, layers=3, lazy_sn=False, **kwargs):
         super(PatchDiscriminator, self).__init__(**kwargs)
-        self._enc = mx.gluon.nn.Sequential()
+        self._enc = mx.gluon.nn.HybridSequential()
         with self.name_scope():
             self._enc.add(
-                SNConv2D(filters, 4, 2, 1, channels),
+                SNConv2D(filters, 4, 2, 1, channels, lazy=lazy_sn),
                 mx.gluon.nn.LeakyReLU(0.2)
             )
             for i in range(1, layers):
                 self._enc.add(
-                    SNConv2D(min(2 ** i, 8) * filters, 4, 2, 1, min(2 ** (i - 1), 8) * filters),
+                    SNConv2D(min(2 ** i, 8) * filters, 4, 2, 1, min(2 ** (i - 1), 8) * filters, lazy=lazy_sn),
                     mx.gluon.nn.LeakyReLU(0.2)
                 )
             units = min(2 ** layers, 8) * filters
             self._enc.add(
-                SNConv2D(units, 4, 1, 1, min(2 ** (layers - 1), 8) * filters),
+                SNConv2D(units, 4, 1, 1, min(2 ** (layers - 1), 8) * filters, lazy=lazy_sn),
                 mx.gluon.nn.LeakyReLU(0.2)
             )
             self._cam = ClassActivationMapping(units, mx.gluon.nn.LeakyReLU(0.2))
-            self._dec = SNConv2D(1, 4, 1, 1, units)
+            self._dec = SNConv2D(1, 4, 1, 1, units, lazy=lazy_sn)
 
-    def forward(self, x):
+    def hybrid_forward(self, F, x):
         x, y = self._cam(self._enc(x))
         return self._dec(x), y
 
 
+def power_iterate(net):
+    def iterate(block):
+        if isinstance(block, SNConv2D):
+            block.power_iterate()
+    net.apply(iterate)
+
+
+def freeze(net):
+    def freeze_block(block):
+        if isinstance(block, SNConv2D):
+            block.freeze()
+    net.apply(freeze_block)
+
+
 @mx.init.register
 class GANInitializer(mx.init.Initializer):
     def __init__(self, **kwargs):
@@ -185,6 +254,8 @@ if __name__ == "__main__":
     net_g.initialize(GANInitializer())
     net_d = PatchDiscriminator()
     net_d.initialize(GANInitializer())
+    net_g.hybridize()
+    net_d.hybridize()
     real_in = mx.nd.zeros((4, 3, 256, 256))
     real_out = mx.nd.ones((4, 3, 256, 256))
     real_y, real_cam_y = net_d(real_out)
@@ -0,0 +1,176 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+def cache_key(data, *parts):
+    h = hashlib.sha256(data)
+    for part in parts:
+        h.update(b"\0" + str(part).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._disk_dir = disk_dir
+        self._disk_max_bytes = disk_max_bytes
+        self._disk_bytes = 0
+        self._disk_entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.disk_errors = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            for f in os.listdir(disk_dir):
+                if f.startswith("."):
+                    try:
+                        os.remove(os.path.join(disk_dir, f))
+                    except OSError:
+                        pass
+            files = [(f, os.stat(os.path.join(disk_dir, f))) for f in os.listdir(disk_dir) if not f.startswith(".")]
+            for f, st in sorted(files, key=lambda x: x[1].st_mtime):
+                self._disk_entries[f] = st.st_size
+                self._disk_bytes += st.st_size
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            if key in self._inflight:
+                self.collapsed += 1
+                future = self._inflight[key]
+            else:
+                future = None
+                self._inflight[key] = Future()
+        if future:
+            return future.result()
+        try:
+            value = self._disk_load(key)
+            with self._lock:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.disk_hits += 1
+            if value is None:
+                value = compute()
+                self._disk_store(key, value)
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key).set_exception(e)
+            raise
+        with self._lock:
+            self._insert(key, value)
+            self._inflight.pop(key).set_result(value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "collapsed": self.collapsed,
+                "disk_errors": self.disk_errors,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "disk_entries": len(self._disk_entries),
+                "disk_bytes": self._disk_bytes
+            }
+
+    def _insert(self, key, value):
+        if len(value) > self._max_bytes:
+            return
+        self._entries[key] = value
+        self._bytes += len(value)
+        while self._bytes > self._max_bytes:
+            _, v = self._entries.popitem(last=False)
+            self._bytes -= len(v)
+
+    def _disk_load(self, key):
+        if not self._disk_dir:
+            return None
+        with self._lock:
+            if not key in self._disk_entries:
+                return None
+            self._disk_entries.move_to_end(key)
+        try:
+            with open(os.path.join(self._disk_dir, key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _disk_store(self, key, value):
+        if not self._disk_dir or len(value) > self._disk_max_bytes:
+            return
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=".", dir=self._disk_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(tmp, os.path.join(self._disk_dir, key))
+        except OSError:
+            if tmp:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            with self._lock:
+                self.disk_errors += 1
+            return
+        evicted = []
+        with self._lock:
+            self._disk_bytes += len(value) - self._disk_entries.pop(key, 0)
+            self._disk_entries[key] = len(value)
+            while self._disk_bytes > self._disk_max_bytes:
+                k, size = self._disk_entries.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(k)
+        for k in evicted:
+            try:
+                os.remove(os.path.join(self._disk_dir, k))
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    def compute():
+        time.sleep(0.1)
+        return b"x" * 400
+
+    cache = ResultCache(1000)
+    with ThreadPoolExecutor(8) as executor:
+        keys = [cache_key(str(i % 3).encode(), "vangogh2photo", "ab", 256, "png") for i in range(24)]
+        list(executor.map(lambda key: cache.get(key, compute), keys))
+    print(cache.stats())
@@ -16,26 +16,104 @@
 # along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
 
 
-import io
+import os
 import re
 import sys
-import png
+import time
+import shutil
 import argparse
+import tempfile
+import threading
 import http.server
 import cgi
 import mxnet as mx
-from dataset import reconstruct_color
-from pix2pix_gan import ResnetGenerator
+from dataset import imdecode, resize_short
+from batcher import Batcher
+from image_codec import formats, encode, negotiate
+from result_cache import cache_key, ResultCache
+from video import translate_video
+from inference import warmup_shapes, generate, model_path, model_version, ComputeWorker, ModelRegistry, ReplicaPool
+from metrics import Registry, Counter, Gauge, Histogram
+
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+byte_buckets = [2 ** i for i in range(10, 26, 2)]
+pixel_buckets = [w * h for w, h in [(128, 128), (256, 256), (512, 512), (1024, 768), (1920, 1080), (4096, 3072)]]
+
+registry = Registry()
+request_count = registry.register(Counter("cycle_gan_requests_total", "Requests to /cycle_gan/fake and /cycle_gan/video by status code.", ["code"]))
+request_latency = registry.register(Histogram("cycle_gan_request_seconds", "Latency of requests to /cycle_gan/fake and /cycle_gan/video.", latency_buckets))
+stage_latency = registry.register(Histogram("cycle_gan_stage_seconds", "Latency of each stage, queue and forward are measured from the batcher.", latency_buckets, ["stage"]))
+requests_in_flight = registry.register(Gauge("cycle_gan_requests_in_flight", "Requests being handled."))
+batches_in_flight = registry.register(Gauge("cycle_gan_batches_in_flight", "Batches submitted to the generator and not finished."))
+batch_size = registry.register(Histogram("cycle_gan_batch_size", "Size of the dynamic batches.", [1, 2, 4, 8, 16, 32, 64]))
+request_bytes = registry.register(Histogram("cycle_gan_request_image_bytes", "Size of the posted images.", byte_buckets))
+input_pixels = registry.register(Histogram("cycle_gan_request_image_pixels", "Pixels of the decoded posted images.", pixel_buckets))
+response_bytes = registry.register(Histogram("cycle_gan_response_bytes", "Size of the fake images and videos sent.", byte_buckets))
+video_frames = registry.register(Counter("cycle_gan_video_frames_total", "Frames of the translated videos."))
+ready = registry.register(Gauge("cycle_gan_ready", "Whether warm-up has finished and requests are served.", fn=lambda: float(CycleGAN.ready)))
+startup_seconds = registry.register(Gauge("cycle_gan_startup_seconds", "Duration of each startup phase.", ["phase"]))
+
+def observe_queue(waits):
+    stage = stage_latency.labels("queue")
+    for wait in waits:
+        stage.observe(wait)
+
+def instrument(submit):
+    def timed_submit(batch, *args):
+        ts = time.monotonic()
+        batch_size.observe(len(batch))
+        batches_in_flight.inc()
+        future = submit(batch, *args)
+
+        def done(future):
+            batches_in_flight.dec()
+            stage_latency.labels("forward").observe(time.monotonic() - ts)
+
+        future.add_done_callback(done)
+        return future
+    return timed_submit
 
 
 class CycleGAN(http.server.BaseHTTPRequestHandler):
     _path_pattern = re.compile("^(/[^?\s]*)(\?\S*)?$")
+    _fake_pattern = re.compile("^/cycle_gan/(?:([A-Za-z0-9_-]+)/(ab|ba)/)?(fake|video)$")
+    ready = False
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = registry.expose()
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header("Content-Type", registry.content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/ready":
+            if self.ready:
+                self.send_response(http.HTTPStatus.OK)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_error(http.HTTPStatus.SERVICE_UNAVAILABLE)
+        else:
+            self.send_error(http.HTTPStatus.NOT_FOUND)
 
     def do_POST(self):
-        self._handle_request()
+        ts = time.monotonic()
+        self._status = None
+        requests_in_flight.inc()
+        try:
+            self._handle_request()
+        finally:
+            requests_in_flight.dec()
+            request_count.labels(str(self._status or "error")).inc()
+            request_latency.observe(time.monotonic() - ts)
         sys.stdout.flush()
         sys.stderr.flush()
 
+    def send_response(self, code, message=None):
+        self._status = int(code)
+        super(CycleGAN, self).send_response(code, message)
+
     def end_headers(self):
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "POST")
@@ -47,49 +125,132 @@ class CycleGAN(http.server.BaseHTTPRequestHandler):
         if not m or m.group(0) != self.path:
             self.send_error(http.HTTPStatus.BAD_REQUEST)
             return
-        if m.group(1) == "/cycle_gan/fake":
-            form = cgi.FieldStorage(
-                fp = self.rfile,
-                headers = self.headers,
-                environ = {
-                    "REQUEST_METHOD": "POST",
-                    "CONTENT_TYPE": self.headers["Content-Type"]
-                }
-            )
+        route = self._fake_pattern.match(m.group(1))
+        if route:
+            model = route.group(1) or self.model
+            direction = route.group(2) or self.direction
+            if not self.ready:
+                self.send_error(http.HTTPStatus.SERVICE_UNAVAILABLE)
+                return
+            if not os.path.isfile(model_path(model, direction, self.exported)):
+                self.send_error(http.HTTPStatus.NOT_FOUND)
+                return
+            with stage_latency.labels("parse").time():
+                form = cgi.FieldStorage(
+                    fp = self.rfile,
+                    headers = self.headers,
+                    environ = {
+                        "REQUEST_METHOD": "POST",
+                        "CONTENT_TYPE": self.headers["Content-Type"]
+                    }
+                )
             if not "real" in form:
                 self.send_error(http.HTTPStatus.BAD_REQUEST)
                 return
-            raw = mx.image.imdecode(form["real"].value)
-            real = mx.image.resize_short(raw, self.resize)
-            real = mx.nd.image.normalize(mx.nd.image.to_tensor(real), mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))
-            fake, _ = self.net(real.expand_dims(0).as_in_context(self.context))
-            out = png_encode(reconstruct_color(fake[0].transpose((1, 2, 0))))
+            if route.group(3) == "video":
+                self._video(model, direction, form["real"])
+                return
+            request_bytes.observe(len(form["real"].value))
+            try:
+                fmt, quality = negotiate(self.headers["Accept"], m.group(2), self.quality)
+                out = self._fake(model, direction, form["real"].value, fmt, quality)
+            except ValueError:
+                self.send_error(http.HTTPStatus.BAD_REQUEST)
+                return
+            except RuntimeError:
+                self.send_error(http.HTTPStatus.SERVICE_UNAVAILABLE)
+                return
+            mime, ext = formats[fmt]
             self.protocol_version = "HTTP/1.1"
             self.send_response(http.HTTPStatus.OK)
-            self.send_header("Content-Type", "image/png")
-            self.send_header("Content-Disposition", "fake.png")
+            self.send_header("Content-Type", mime)
+            self.send_header("Content-Disposition", "fake" + ext)
+            self.send_header("Vary", "Accept")
             self.send_header("Content-Length", str(len(out)))
             self.end_headers()
-            self.wfile.write(out)
+            with stage_latency.labels("write").time():
+                self.wfile.write(out)
+            response_bytes.observe(len(out))
         else:
             self.send_error(http.HTTPStatus.NOT_FOUND)
 
+    def _fake(self, model, direction, data, fmt, quality):
+        def compute():
+            with stage_latency.labels("decode").time():
+                img = imdecode(data)
+            input_pixels.observe(img.shape[0] * img.shape[1])
+            with stage_latency.labels("resize").time():
+                x = resize_short(img, self.resize)
+            with stage_latency.labels("generate").time():
+                y = self.batcher(x, *self._generator(model, direction))
+            with stage_latency.labels("encode").time():
+                return encode(y, fmt, quality)
+        if not self.cache:
+            return compute()
+        return self.cache.get(cache_key(data, model, direction, model_version(model, direction, self.exported), self.resize, fmt, quality), compute)
+
+    def _generator(self, model, direction):
+        if self.models:
+            return (self.models.get(model, direction),)
+        return (model, direction)
+
+    def _video(self, model, direction, field):
+        if field.file is None:
+            self.send_error(http.HTTPStatus.BAD_REQUEST)
+            return
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "real" + os.path.splitext(field.filename or "")[1])
+            dst = os.path.join(tmp, "fake.mp4")
+            with open(src, "wb") as f:
+                field.file.seek(0)
+                shutil.copyfileobj(field.file, f)
+            generator = []
+
+            def submit(x):
+                if not generator:
+                    generator.extend(self._generator(model, direction))
+                return self.batcher.submit(x, *generator)
 
-def png_encode(img):
-    height = img.shape[0]
-    width = img.shape[1]
-    img = img.reshape((-1, width * 3))
-    f = io.BytesIO()
-    w = png.Writer(width, height, greyscale=False)
-    w.write(f, img.asnumpy())
-    return f.getvalue()
+            try:
+                with stage_latency.labels("video").time():
+                    frames, _ = translate_video(src, dst, submit, self.resize, self.video_depth)
+            except ValueError:
+                self.send_error(http.HTTPStatus.BAD_REQUEST)
+                return
+            except RuntimeError:
+                self.send_error(http.HTTPStatus.SERVICE_UNAVAILABLE)
+                return
+            video_frames.inc(frames)
+            size = os.path.getsize(dst)
+            self.protocol_version = "HTTP/1.1"
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Disposition", "fake.mp4")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            with stage_latency.labels("write").time(), open(dst, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+            response_bytes.observe(size)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="This is CycleGAN demo server.")
     parser.add_argument("--reversed", help="reverse transformation", action="store_true")
-    parser.add_argument("--model", help="set the model used by the server (default: vangogh2photo)", type=str, default="vangogh2photo")
+    parser.add_argument("--model", help="set the model served at /cycle_gan/fake and loaded at startup, other models in model/ are served at /cycle_gan/MODEL/DIRECTION/fake (default: vangogh2photo)", type=str, default="vangogh2photo")
+    parser.add_argument("--exported", help="load the generator exported by export.py", action="store_true")
+    parser.add_argument("--model_memory", help="set the budget in MB of the parameters of the loaded generators of each replica, least recently used ones are unloaded beyond it, the workspaces of their warmed-up shapes are not counted, 0 means unlimited (default: 1024)", type=float, default=1024)
     parser.add_argument("--resize", help="set the short size of fake image (default: 256)", type=int, default=256)
+    parser.add_argument("--quality", help="set the default quality of jpeg/webp output (default: 90)", type=int, default=90)
+    parser.add_argument("--max_batch_size", help="set the max size of a dynamic batch (default: 8)", type=int, default=8)
+    parser.add_argument("--video_depth", help="set the max number of frames of a video in flight between decoding and encoding (default: 32)", type=int, default=32)
+    parser.add_argument("--max_delay", help="set the max time in ms to wait for a dynamic batch (default: 5)", type=float, default=5)
+    parser.add_argument("--replicas", help="set the number of generator worker processes sharing the cpu cores, 0 means inference in the server process (default: 0)", type=int, default=0)
+    parser.add_argument("--threads", help="set the number of threads of each replica, 0 means its share of cores (default: 0)", type=int, default=0)
+    parser.add_argument("--cache_size", help="set the size in MB of the in-memory result cache, 0 means disabled (default: 0)", type=float, default=0)
+    parser.add_argument("--cache_dir", help="set the directory of the on-disk result cache (default: disabled)", type=str, default=None)
+    parser.add_argument("--cache_disk_size", help="set the size in MB of the on-disk result cache (default: 1024)", type=float, default=1024)
+    parser.add_argument("--warmup_aspects", help="set the aspect ratios W:H of the images warmed up at --resize before serving (default: 1:1 4:3 3:4)", type=str, nargs="*", default=["1:1", "4:3", "3:4"])
+    parser.add_argument("--warmup_batch_sizes", help="set the batch sizes warmed up before serving (default: every size from 1 to --max_batch_size)", type=int, nargs="*", default=None)
     parser.add_argument("--addr", help="set address of cycle_gan server (default: 0.0.0.0)", type=str, default="0.0.0.0")
     parser.add_argument("--port", help="set port of cycle_gan server (default: 80)", type=int, default=80)
     parser.add_argument("--device_id", help="select device that the model using (default: 0)", type=int, default=0)
@@ -97,18 +258,63 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     CycleGAN.resize = args.resize
+    CycleGAN.quality = args.quality
+    CycleGAN.model = args.model
+    CycleGAN.direction = "ba" if args.reversed else "ab"
+    CycleGAN.exported = args.exported
+    CycleGAN.video_depth = args.video_depth
+    if args.cache_size > 0 or args.cache_dir:
+        CycleGAN.cache = ResultCache(int(args.cache_size * 2 ** 20), args.cache_dir, int(args.cache_disk_size * 2 ** 20))
+    else:
+        CycleGAN.cache = None
 
+    if args.replicas > 0 and args.gpu:
+        parser.error("replicas are cpu only")
     if args.gpu:
         CycleGAN.context = mx.gpu(args.device_id)
     else:
         CycleGAN.context = mx.cpu(args.device_id)
 
+    ts = time.time()
+    httpd = http.server.ThreadingHTTPServer((args.addr, args.port), CycleGAN)
+    httpd.daemon_threads = True
+    serving = threading.Thread(target=httpd.serve_forever, daemon=True)
+    serving.start()
+    phases = {"bind": time.time() - ts}
+
+    aspects = [tuple(int(v) for v in aspect.split(":")) for aspect in args.warmup_aspects]
+    batch_sizes = args.warmup_batch_sizes if args.warmup_batch_sizes is not None else list(range(1, args.max_batch_size + 1))
+    warmup = warmup_shapes(args.resize, aspects, batch_sizes)
     print("Loading model...", flush=True)
-    CycleGAN.net = ResnetGenerator()
-    if args.reversed:
-        CycleGAN.net.load_parameters("model/{}.gen_ba.params".format(args.model), ctx=CycleGAN.context)
+    if args.replicas > 0:
+        pool = ReplicaPool(args.model, CycleGAN.direction, args.exported, args.replicas, args.threads, warmup, int(args.model_memory * 2 ** 20))
+        phases.update({phase: max(p[phase] for p in pool.phases) for phase in pool.phases[0]})
+        submit = pool.submit
+        model_stats = pool.stats
+        registry.register(Gauge("cycle_gan_replica_respawns", "Replicas respawned after exiting.", fn=lambda: float(pool.respawns)))
+        CycleGAN.models = None
     else:
-        CycleGAN.net.load_parameters("model/{}.gen_ab.params".format(args.model), ctx=CycleGAN.context)
+        worker = ComputeWorker()
+        models = ModelRegistry(CycleGAN.context, args.exported, int(args.model_memory * 2 ** 20), warmup, worker)
+        models.get(args.model, CycleGAN.direction)
+        phases.update(models.phases[(args.model, CycleGAN.direction)])
+
+        def submit(batch, net):
+            return worker.submit(generate, net, CycleGAN.context, batch)
+
+        model_stats = models.stats
+        CycleGAN.models = models
+    for key in ("resident", "bytes", "loads", "evictions"):
+        registry.register(Gauge("cycle_gan_models_" + key, "Model registry statistic %s, summed over replicas." % key, fn=lambda key=key: model_stats().get(key, 0)))
+    CycleGAN.batcher = Batcher(instrument(submit), args.max_batch_size, args.max_delay / 1000, observe_queue)
+    registry.register(Gauge("cycle_gan_queue_depth", "Requests waiting to be batched.", fn=CycleGAN.batcher.qsize))
+    if CycleGAN.cache:
+        for key in CycleGAN.cache.stats():
+            registry.register(Gauge("cycle_gan_cache_" + key, "Result cache statistic %s." % key, fn=lambda key=key: CycleGAN.cache.stats()[key]))
 
-    httpd = http.server.HTTPServer((args.addr, args.port), CycleGAN)
-    httpd.serve_forever()
+    phases["total"] = time.time() - ts
+    for phase, duration in phases.items():
+        startup_seconds.labels(phase).set(duration)
+    CycleGAN.ready = True
+    print("Ready in %.2fs (%s, %d warm-up shapes)" % (phases["total"], "  ".join("%s %.2fs" % (k, v) for k, v in phases.items() if k != "total"), len(warmup)), flush=True)
+    serving.join()
@@ -20,7 +20,7 @@ import argparse
 import mxnet as mx
 import matplotlib.pyplot as plt
 from dataset import load_image, reconstruct_color
-from pix2pix_gan import ResnetGenerator, PatchDiscriminator
+from pix2pix_gan import ResnetGenerator, PatchDiscriminator, freeze
 
 def test(images, model, is_reversed, size, context):
     print("Loading models...", flush=True)
@@ -32,6 +32,9 @@ def test(images, model, is_reversed, size, context):
     gen_ab.load_parameters("model/{}.gen_ab.params".format(model), ctx=context)
     gen_ba = ResnetGenerator()
     gen_ba.load_parameters("model/{}.gen_ba.params".format(model), ctx=context)
+    for net in (dis_a, dis_b, gen_ab, gen_ba):
+        freeze(net)
+        net.hybridize()
 
     for path in images:
         print(path)
@@ -17,27 +17,182 @@
 
 
 import os
+import sys
 import time
 import random
 import argparse
+import contextlib
+import numpy as np
 import mxnet as mx
-from dataset import load_dataset, get_batches
-from pix2pix_gan import ResnetGenerator, PatchDiscriminator, GANInitializer
+from dataset import load_training_set, shard_dataset, get_batches, Prefetcher, ProcessLoader
+from pix2pix_gan import ResnetGenerator, PatchDiscriminator, GANInitializer, power_iterate
 from image_pool import ImagePool
+from checkpoint import Checkpointer, load_checkpoint
+from metrics import PhaseTimer, MetricsLogger, memory_usage
 
-def train(dataset, start_epoch, max_epochs, lr_d, lr_g, batch_size, lmda_cyc, lmda_idt, pool_size, context):
+def step_range(value):
+    try:
+        start, end = (int(i) for i in value.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected START:END, got %s" % value)
+    if not 0 <= start < end:
+        raise argparse.ArgumentTypeError("expected 0 <= START < END, got %s" % value)
+    return start, end
+
+bce_loss = mx.gluon.loss.SigmoidBinaryCrossEntropyLoss()
+l1_loss = mx.gluon.loss.L1Loss()
+
+def sync_parameters(kv, net):
+    for param in net.collect_params().values():
+        value = param.data(param.list_ctx()[0]).copy()
+        kv.broadcast("w:" + param.name, value, out=value)
+        param.set_data(value)
+        if param.grad_req != "null":
+            kv.init(param.name, param.list_grad()[0])
+
+def check_shared_directory(kv, path):
+    token = mx.nd.array([int.from_bytes(os.urandom(3), "little") if kv.rank == 0 else 0])
+    if kv.rank == 0:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(str(int(token.asscalar())))
+    kv.broadcast("shared:token", token, out=token)
+    try:
+        with open(path) as f:
+            mismatch = int(f.read()) != int(token.asscalar())
+    except (OSError, ValueError):
+        mismatch = True
+    mismatches = mx.nd.array([float(mismatch)])
+    kv.init("shared:mismatches", mx.nd.zeros(1))
+    kv.pushpull("shared:mismatches", mismatches, out=mismatches)
+    if kv.rank == 0:
+        os.remove(path)
+    return mismatches.asscalar() == 0
+
+def checkpoint_position(dataset):
+    manifest = load_checkpoint("model/{}".format(dataset))
+    return manifest and (manifest["epoch"], manifest["batch"])
+
+def parameters_finite(nets, ctx):
+    total = mx.nd.add_n(*[param.data(ctx).sum() for net in nets for param in net.collect_params().values()])
+    return bool(np.isfinite(total.asscalar()))
+
+def allreduce_gradients(kv, net):
+    for i, param in enumerate(net.collect_params().values()):
+        if param.grad_req != "null":
+            kv.pushpull(param.name, param.list_grad(), out=param.list_grad(), priority=-i)
+
+def train_step(nets, trainers, pools, real_a, real_b, lmda_cyc, lmda_idt, context, step_size, dist=None, timer=None):
+    mark = timer or (lambda phase: None)
+    mark("generator_forward")
+    gen_ab, gen_ba, dis_a, dis_b = nets
+    trainer_gen_ab, trainer_gen_ba, trainer_dis_a, trainer_dis_b = trainers
+    fake_a_pool, fake_b_pool = pools
+    real_a = mx.gluon.utils.split_and_load(real_a, context, even_split=False)
+    real_b = mx.gluon.utils.split_and_load(real_b, context, even_split=False)
+
+    with mx.autograd.record():
+        gen_a = [gen_ba(x) for x in real_b]
+        gen_b = [gen_ab(x) for x in real_a]
+    mark("image_pool")
+    pool_a = mx.gluon.utils.split_and_load(fake_a_pool.query(mx.nd.concat(*[y.detach().as_in_context(context[0]) for y, _ in gen_a], dim=0)), context, even_split=False)
+    pool_b = mx.gluon.utils.split_and_load(fake_b_pool.query(mx.nd.concat(*[y.detach().as_in_context(context[0]) for y, _ in gen_b], dim=0)), context, even_split=False)
+
+    mark("dis_a_backward")
+    with mx.autograd.record():
+        Ls = []
+        for x, fake_x in zip(real_a, pool_a):
+            real_a_y, real_a_cam_y = dis_a(x.detach())
+            real_a_L = bce_loss(real_a_y, mx.nd.ones_like(real_a_y))
+            real_a_cam_L = bce_loss(real_a_cam_y, mx.nd.ones_like(real_a_cam_y))
+            fake_a_y, fake_a_cam_y = dis_a(fake_x)
+            fake_a_L = bce_loss(fake_a_y, mx.nd.zeros_like(fake_a_y))
+            fake_a_cam_L = bce_loss(fake_a_cam_y, mx.nd.zeros_like(fake_a_cam_y))
+            Ls.append(real_a_L + real_a_cam_L + fake_a_L + fake_a_cam_L)
+    mx.autograd.backward(Ls)
+    mark("dis_a_step")
+    if dist:
+        allreduce_gradients(dist, dis_a)
+    trainer_dis_a.step(step_size)
+    power_iterate(dis_a)
+    dis_a_L = mx.nd.add_n(*[L.sum().as_in_context(context[0]) for L in Ls])
+
+    mark("dis_b_backward")
+    with mx.autograd.record():
+        Ls = []
+        for x, fake_x in zip(real_b, pool_b):
+            real_b_y, real_b_cam_y = dis_b(x.detach())
+            real_b_L = bce_loss(real_b_y, mx.nd.ones_like(real_b_y))
+            real_b_cam_L = bce_loss(real_b_cam_y, mx.nd.ones_like(real_b_cam_y))
+            fake_b_y, fake_b_cam_y = dis_b(fake_x)
+            fake_b_L = bce_loss(fake_b_y, mx.nd.zeros_like(fake_b_y))
+            fake_b_cam_L = bce_loss(fake_b_cam_y, mx.nd.zeros_like(fake_b_cam_y))
+            Ls.append(real_b_L + real_b_cam_L + fake_b_L + fake_b_cam_L)
+    mx.autograd.backward(Ls)
+    mark("dis_b_step")
+    if dist:
+        allreduce_gradients(dist, dis_b)
+    trainer_dis_b.step(step_size)
+    power_iterate(dis_b)
+    dis_b_L = mx.nd.add_n(*[L.sum().as_in_context(context[0]) for L in Ls])
+
+    mark("gen_backward")
+    with mx.autograd.record():
+        Ls = []
+        for x_a, x_b, (fake_a, gen_a_cam_y), (fake_b, gen_b_cam_y) in zip(real_a, real_b, gen_a, gen_b):
+            fake_a_y, fake_a_cam_y = dis_a(fake_a)
+            gan_a_L = bce_loss(fake_a_y, mx.nd.ones_like(fake_a_y))
+            gan_a_cam_L = bce_loss(fake_a_cam_y, mx.nd.ones_like(fake_a_cam_y))
+            rec_b, _ = gen_ab(fake_a)
+            cyc_b_L = l1_loss(rec_b, x_b)
+            idt_a, idt_a_cam_y = gen_ba(x_a)
+            idt_a_L = l1_loss(idt_a, x_a)
+            gen_a_cam_L = bce_loss(gen_a_cam_y, mx.nd.ones_like(gen_a_cam_y)) + bce_loss(idt_a_cam_y, mx.nd.zeros_like(idt_a_cam_y))
+            gen_ba_L = gan_a_L + gan_a_cam_L + cyc_b_L * lmda_cyc + idt_a_L * lmda_cyc * lmda_idt + gen_a_cam_L
+            fake_b_y, fake_b_cam_y = dis_b(fake_b)
+            gan_b_L = bce_loss(fake_b_y, mx.nd.ones_like(fake_b_y))
+            gan_b_cam_L = bce_loss(fake_b_cam_y, mx.nd.ones_like(fake_b_cam_y))
+            rec_a, _ = gen_ba(fake_b)
+            cyc_a_L = l1_loss(rec_a, x_a)
+            idt_b, idt_b_cam_y = gen_ab(x_b)
+            idt_b_L = l1_loss(idt_b, x_b)
+            gen_b_cam_L = bce_loss(gen_b_cam_y, mx.nd.ones_like(gen_b_cam_y)) + bce_loss(idt_b_cam_y, mx.nd.zeros_like(idt_b_cam_y))
+            gen_ab_L = gan_b_L + gan_b_cam_L + cyc_a_L * lmda_cyc + idt_b_L * lmda_cyc * lmda_idt + gen_b_cam_L
+            Ls.append(gen_ba_L + gen_ab_L)
+    mx.autograd.backward(Ls)
+    mark("gen_step")
+    if dist:
+        allreduce_gradients(dist, gen_ba)
+        allreduce_gradients(dist, gen_ab)
+    trainer_gen_ba.step(step_size)
+    trainer_gen_ab.step(step_size)
+    power_iterate(gen_ba)
+    power_iterate(gen_ab)
+    gen_L = mx.nd.add_n(*[L.sum().as_in_context(context[0]) for L in Ls])
+    return mx.nd.concat(dis_a_L, dis_b_L, gen_L, dim=0)
+
+def train(dataset, start_epoch, max_epochs, lr_d, lr_g, batch_size, lmda_cyc, lmda_idt, pool_size, prefetch, shards, loader_processes, log_interval, checkpoint_interval, context, kvstore="device", reseed=False, metrics=None, profile_steps=None, profile_file="profile.json"):
     mx.random.seed(int(time.time()))
 
+    dist = None
+    rank, num_workers = 0, 1
+    step_size = batch_size
+    if isinstance(kvstore, mx.kv.KVStore):
+        dist, kvstore = kvstore, "device"
+        rank, num_workers = dist.rank, dist.num_workers
+        step_size = batch_size * num_workers * len(context)
+        print("Worker %d of %d" % (rank, num_workers), flush=True)
+        if not check_shared_directory(dist, "model/{}.shared".format(dataset)):
+            sys.exit("Every worker of distributed training must see the same model/ directory.")
+
     print("Loading dataset...", flush=True)
-    training_set_a = load_dataset(dataset, "trainA")
-    training_set_b = load_dataset(dataset, "trainB")
+    training_set_a = shard_dataset(load_training_set(dataset, "trainA", shards=shards), rank, num_workers)
+    training_set_b = shard_dataset(load_training_set(dataset, "trainB", shards=shards), rank, num_workers)
 
-    gen_ab = ResnetGenerator()
-    dis_b = PatchDiscriminator()
-    gen_ba = ResnetGenerator()
-    dis_a = PatchDiscriminator()
-    bce_loss = mx.gluon.loss.SigmoidBinaryCrossEntropyLoss()
-    l1_loss = mx.gluon.loss.L1Loss()
+    gen_ab = ResnetGenerator(lazy_sn=True)
+    dis_b = PatchDiscriminator(lazy_sn=True)
+    gen_ba = ResnetGenerator(lazy_sn=True)
+    dis_a = PatchDiscriminator(lazy_sn=True)
 
     gen_ab_params_file = "model/{}.gen_ab.params".format(dataset)
     dis_b_params_file = "model/{}.dis_b.params".format(dataset)
@@ -68,24 +223,30 @@ def train(dataset, start_epoch, max_epochs, lr_d, lr_g, batch_size, lmda_cyc, lm
     else:
         dis_a.initialize(GANInitializer(), ctx=context)
 
+    for net in (gen_ab, dis_b, gen_ba, dis_a):
+        if dist:
+            net(mx.nd.zeros((1, 3, 256, 256), ctx=context[0]))
+        power_iterate(net)
+        net.hybridize()
+
     print("Learning rate of discriminator:", lr_d, flush=True)
     print("Learning rate of generator:", lr_g, flush=True)
     trainer_gen_ab = mx.gluon.Trainer(gen_ab.collect_params(), "Nadam", {
         "learning_rate": lr_g,
         "beta1": 0.5
-    })
+    }, kvstore=kvstore)
     trainer_dis_b = mx.gluon.Trainer(dis_b.collect_params(), "Nadam", {
         "learning_rate": lr_d,
         "beta1": 0.5
-    })
+    }, kvstore=kvstore)
     trainer_gen_ba = mx.gluon.Trainer(gen_ba.collect_params(), "Nadam", {
         "learning_rate": lr_g,
         "beta1": 0.5
-    })
+    }, kvstore=kvstore)
     trainer_dis_a = mx.gluon.Trainer(dis_a.collect_params(), "Nadam", {
         "learning_rate": lr_d,
         "beta1": 0.5
-    })
+    }, kvstore=kvstore)
 
     if os.path.isfile(gen_ab_state_file):
         trainer_gen_ab.load_states(gen_ab_state_file)
@@ -101,101 +262,204 @@ def train(dataset, start_epoch, max_epochs, lr_d, lr_g, batch_size, lmda_cyc, lm
 
     fake_a_pool = ImagePool(pool_size)
     fake_b_pool = ImagePool(pool_size)
+    nets = (gen_ab, gen_ba, dis_a, dis_b)
+    trainers = (trainer_gen_ab, trainer_gen_ba, trainer_dis_a, trainer_dis_b)
+    pools = (fake_a_pool, fake_b_pool)
+
+    checkpointer = Checkpointer("model/{}".format(dataset), {
+        "gen_ab": gen_ab,
+        "gen_ba": gen_ba,
+        "dis_a": dis_a,
+        "dis_b": dis_b
+    }, {
+        "gen_ab": trainer_gen_ab,
+        "gen_ba": trainer_gen_ba,
+        "dis_a": trainer_dis_a,
+        "dis_b": trainer_dis_b
+    }, {
+        "fake_a": fake_a_pool,
+        "fake_b": fake_b_pool
+    })
+
+    cursor = None
+    loader_seed = None
+    manifest = load_checkpoint("model/{}".format(dataset))
+    if manifest is not None and manifest["epoch"] >= start_epoch:
+        print("Resuming from epoch %d batch %d..." % (manifest["epoch"], manifest["batch"]), flush=True)
+        checkpointer.restore(manifest, context)
+        random.setstate(manifest["random"])
+        np.random.set_state(manifest["np_random"])
+        mx.random.seed(manifest["mx_seed"])
+        if reseed:
+            seed = int(time.time())
+            random.seed(seed)
+            np.random.seed(seed % 2 ** 32)
+            mx.random.seed(seed)
+        else:
+            loader_seed = manifest.get("loader_seed")
+        start_epoch = manifest["epoch"]
+        if manifest["batch"] > 0:
+            cursor = manifest
+    if loader_seed is None:
+        loader_seed = random.getrandbits(31)
+
+    if dist:
+        for net in (gen_ab, dis_b, gen_ba, dis_a):
+            sync_parameters(dist, net)
+
+    if num_workers > 1:
+        metrics = metrics and "%s.%d" % (metrics, rank)
+        profile_file = "%s.%d" % (profile_file, rank)
+    if profile_steps:
+        profile_start, profile_end = profile_steps
+        mx.profiler.set_config(profile_all=True, aggregate_stats=True, filename=profile_file)
+    timer = PhaseTimer() if metrics or profile_steps else None
+    step_timer = None
+    step = 0
+    profiling = False
+
+    def next_step():
+        nonlocal step_timer, profiling
+        if timer is None:
+            return
+        in_range = profile_steps and profile_start <= step < profile_end
+        if in_range and not profiling:
+            print("Profiling steps %d to %d..." % (profile_start, profile_end), flush=True)
+            timer.domain = mx.profiler.Domain("train")
+            mx.profiler.set_state("run")
+            profiling = True
+        elif profiling and not in_range:
+            stop_profile()
+        step_timer = timer if metrics or profiling else None
+        if step_timer:
+            timer.reset()
+            timer("data")
+
+    def stop_profile():
+        nonlocal profiling
+        profiling = False
+        timer.reset()
+        mx.profiler.set_state("stop")
+        mx.profiler.dump()
+        timer.domain = None
+        print("Profile saved to %s" % profile_file, flush=True)
+
+    loader = ProcessLoader(training_set_a, training_set_b, batch_size, processes=loader_processes, seed=loader_seed) if loader_processes > 0 else contextlib.nullcontext()
 
     print("Training...", flush=True)
-    for epoch in range(start_epoch, max_epochs):
-        ts = time.time()
-
-        random.shuffle(training_set_a)
-        random.shuffle(training_set_b)
-
-        training_dis_a_L = 0.0
-        training_dis_b_L = 0.0
-        training_gen_L = 0.0
-        training_batch = 0
-
-        for real_a, real_b in get_batches(training_set_a, training_set_b, batch_size, ctx=context):
-            training_batch += 1
-            
-            fake_a, _ = gen_ba(real_b)
-            fake_b, _ = gen_ab(real_a)
-
-            with mx.autograd.record():
-                real_a_y, real_a_cam_y = dis_a(real_a)
-                real_a_L = bce_loss(real_a_y, mx.nd.ones_like(real_a_y, ctx=context))
-                real_a_cam_L = bce_loss(real_a_cam_y, mx.nd.ones_like(real_a_cam_y, ctx=context))
-                fake_a_y, fake_a_cam_y = dis_a(fake_a_pool.query(fake_a))
-                fake_a_L = bce_loss(fake_a_y, mx.nd.zeros_like(fake_a_y, ctx=context))
-                fake_a_cam_L = bce_loss(fake_a_cam_y, mx.nd.zeros_like(fake_a_cam_y, ctx=context))
-                L = real_a_L + real_a_cam_L + fake_a_L + fake_a_cam_L
-                L.backward()
-            trainer_dis_a.step(batch_size)
-            dis_a_L = mx.nd.mean(L).asscalar()
-            if dis_a_L != dis_a_L:
-                raise ValueError()
-
-            with mx.autograd.record():
-                real_b_y, real_b_cam_y = dis_b(real_b)
-                real_b_L = bce_loss(real_b_y, mx.nd.ones_like(real_b_y, ctx=context))
-                real_b_cam_L = bce_loss(real_b_cam_y, mx.nd.ones_like(real_b_cam_y, ctx=context))
-                fake_b_y, fake_b_cam_y = dis_b(fake_b_pool.query(fake_b))
-                fake_b_L = bce_loss(fake_b_y, mx.nd.zeros_like(fake_b_y, ctx=context))
-                fake_b_cam_L = bce_loss(fake_b_cam_y, mx.nd.zeros_like(fake_b_cam_y, ctx=context))
-                L = real_b_L + real_b_cam_L + fake_b_L + fake_b_cam_L
-                L.backward()
-            trainer_dis_b.step(batch_size)
-            dis_b_L = mx.nd.mean(L).asscalar()
-            if dis_b_L != dis_b_L:
-                raise ValueError()
-
-            with mx.autograd.record():
-                fake_a, gen_a_cam_y = gen_ba(real_b)
-                fake_a_y, fake_a_cam_y = dis_a(fake_a)
-                gan_a_L = bce_loss(fake_a_y, mx.nd.ones_like(fake_a_y, ctx=context))
-                gan_a_cam_L = bce_loss(fake_a_cam_y, mx.nd.ones_like(fake_a_cam_y, ctx=context))
-                rec_b, _ = gen_ab(fake_a)
-                cyc_b_L = l1_loss(rec_b, real_b)
-                idt_a, idt_a_cam_y = gen_ba(real_a)
-                idt_a_L = l1_loss(idt_a, real_a)
-                gen_a_cam_L = bce_loss(gen_a_cam_y, mx.nd.ones_like(gen_a_cam_y, ctx=context)) + bce_loss(idt_a_cam_y, mx.nd.zeros_like(idt_a_cam_y, ctx=context))
-                gen_ba_L = gan_a_L + gan_a_cam_L + cyc_b_L * lmda_cyc + idt_a_L * lmda_cyc * lmda_idt + gen_a_cam_L
-                fake_b, gen_b_cam_y = gen_ab(real_a)
-                fake_b_y, fake_b_cam_y = dis_b(fake_b)
-                gan_b_L = bce_loss(fake_b_y, mx.nd.ones_like(fake_b_y, ctx=context))
-                gan_b_cam_L = bce_loss(fake_b_cam_y, mx.nd.ones_like(fake_b_cam_y, ctx=context))
-                rec_a, _ = gen_ba(fake_b)
-                cyc_a_L = l1_loss(rec_a, real_a)
-                idt_b, idt_b_cam_y = gen_ab(real_b)
-                idt_b_L = l1_loss(idt_b, real_b)
-                gen_b_cam_L = bce_loss(gen_b_cam_y, mx.nd.ones_like(gen_b_cam_y, ctx=context)) + bce_loss(idt_b_cam_y, mx.nd.zeros_like(idt_b_cam_y, ctx=context))
-                gen_ab_L = gan_b_L + gan_b_cam_L + cyc_a_L * lmda_cyc + idt_b_L * lmda_cyc * lmda_idt + gen_b_cam_L
-                L = gen_ba_L + gen_ab_L
-                L.backward()
-            trainer_gen_ba.step(batch_size)
-            trainer_gen_ab.step(batch_size)
-            gen_L = mx.nd.mean(L).asscalar()
-            if gen_L != gen_L:
-                raise ValueError()
-
-            training_dis_a_L += dis_a_L
-            training_dis_b_L += dis_b_L
-            training_gen_L += gen_L
-            print("[Epoch %d  Batch %d]  dis_a_loss %.10f  dis_b_loss %.10f  gen_loss %.10f  elapsed %.2fs" % (
-                epoch, training_batch, dis_a_L, dis_b_L, gen_L, time.time() - ts
+    with checkpointer, MetricsLogger(metrics) as logger, loader:
+        for epoch in range(start_epoch, max_epochs):
+            ts = time.time()
+
+            if cursor is None:
+                order_a = list(range(len(training_set_a)))
+                order_b = list(range(len(training_set_b)))
+                random.shuffle(order_a)
+                random.shuffle(order_b)
+                training_dis_a_L = 0.0
+                training_dis_b_L = 0.0
+                training_gen_L = 0.0
+                training_batch = 0
+            else:
+                order_a = cursor["order_a"]
+                order_b = cursor["order_b"]
+                training_dis_a_L, training_dis_b_L, training_gen_L = cursor["losses"]
+                training_batch = cursor["batch"]
+                cursor = None
+            interval_L = None
+            interval_batch = 0
+
+            def log_losses():
+                nonlocal training_dis_a_L, training_dis_b_L, training_gen_L, interval_L, interval_batch
+                dis_a_L, dis_b_L, gen_L = interval_L.asnumpy() / interval_batch
+                if dis_a_L != dis_a_L or dis_b_L != dis_b_L or gen_L != gen_L:
+                    raise ValueError()
+                training_dis_a_L += dis_a_L * interval_batch
+                training_dis_b_L += dis_b_L * interval_batch
+                training_gen_L += gen_L * interval_batch
+                interval_L = None
+                interval_batch = 0
+                print("[Epoch %d  Batch %d]  dis_a_loss %.10f  dis_b_loss %.10f  gen_loss %.10f  elapsed %.2fs  data_wait %.2fs" % (
+                    epoch, training_batch, dis_a_L, dis_b_L, gen_L, time.time() - ts, batches.wait_time
+                ), flush=True)
+
+            def save_checkpoint(epoch, batch, export=None):
+                if interval_batch > 0:
+                    log_losses()
+                if not parameters_finite(nets, context[0]):
+                    raise ValueError()
+                if rank != 0:
+                    return
+                seed = random.getrandbits(31)
+                mx.random.seed(seed)
+                checkpointer.save({
+                    "epoch": epoch,
+                    "batch": batch,
+                    "order_a": order_a,
+                    "order_b": order_b,
+                    "losses": (training_dis_a_L, training_dis_b_L, training_gen_L),
+                    "random": random.getstate(),
+                    "np_random": np.random.get_state(),
+                    "mx_seed": seed,
+                    "loader_seed": loader_seed
+                }, export)
+
+            if loader_processes > 0:
+                epoch_batches = loader.batches(order_a, order_b, epoch, training_batch, context[0])
+            else:
+                epoch_set_a = [training_set_a[i] for i in order_a]
+                epoch_set_b = [training_set_b[i] for i in order_b]
+                epoch_batches = get_batches(epoch_set_a, epoch_set_b, batch_size, ctx=context[0], start=training_batch)
+            with Prefetcher(epoch_batches, prefetch) as batches:
+                next_step()
+                for real_a, real_b in batches:
+                    training_batch += 1
+                    losses = train_step(nets, trainers, pools, real_a, real_b, lmda_cyc, lmda_idt, context, step_size, dist, step_timer) / batch_size
+                    interval_L = losses if interval_L is None else interval_L + losses
+                    interval_batch += 1
+                    if interval_batch >= log_interval:
+                        if step_timer:
+                            step_timer("loss_sync")
+                        log_losses()
+                    if checkpoint_interval > 0 and training_batch % checkpoint_interval == 0:
+                        if step_timer:
+                            step_timer("checkpoint")
+                        save_checkpoint(epoch, training_batch)
+                    step += 1
+                    if metrics:
+                        phases = timer.reset()
+                        step_time = sum(phases.values())
+                        logger.write(dict({
+                            "epoch": epoch,
+                            "batch": training_batch,
+                            "step": step,
+                            "time": time.time(),
+                            "step_time": step_time,
+                            "samples_per_sec": real_a.shape[0] / step_time,
+                            "phases": phases
+                        }, **memory_usage(context)))
+                    next_step()
+
+                if interval_batch > 0:
+                    log_losses()
+
+            print("[Epoch %d]  training_dis_a_loss %.10f  training_dis_b_loss %.10f  training_gen_loss %.10f  duration %.2fs  data_wait %.2fs" % (
+                epoch + 1, training_dis_a_L / training_batch, training_dis_b_L / training_batch, training_gen_L / training_batch, time.time() - ts, batches.wait_time
             ), flush=True)
 
-        print("[Epoch %d]  training_dis_a_loss %.10f  training_dis_b_loss %.10f  training_gen_loss %.10f  duration %.2fs" % (
-            epoch + 1, training_dis_a_L / training_batch, training_dis_b_L / training_batch, training_gen_L / training_batch, time.time() - ts
-        ), flush=True)
+            save_checkpoint(epoch + 1, 0, {
+                "gen_ab.params": gen_ab_params_file,
+                "gen_ba.params": gen_ba_params_file,
+                "dis_a.params": dis_a_params_file,
+                "dis_b.params": dis_b_params_file,
+                "gen_ab.state": gen_ab_state_file,
+                "gen_ba.state": gen_ba_state_file,
+                "dis_a.state": dis_a_state_file,
+                "dis_b.state": dis_b_state_file
+            })
 
-        gen_ab.save_parameters(gen_ab_params_file)
-        gen_ba.save_parameters(gen_ba_params_file)
-        dis_a.save_parameters(dis_a_params_file)
-        dis_b.save_parameters(dis_b_params_file)
-        trainer_gen_ab.save_states(gen_ab_state_file)
-        trainer_gen_ba.save_states(gen_ba_state_file)
-        trainer_dis_a.save_states(dis_a_state_file)
-        trainer_dis_b.save_states(dis_b_state_file)
+        if profiling:
+            stop_profile()
 
 
 if __name__ == "__main__":
@@ -208,16 +472,35 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", help="set the batch size (default: 32)", type=int, default=32)
     parser.add_argument("--lmda_cyc", help="set the lambda of cycle loss (default: 10.0)", type=float, default=10.0)
     parser.add_argument("--lmda_idt", help="set the lambda of identity loss (default: 0.5)", type=float, default=0.5)
+    parser.add_argument("--prefetch", help="set the number of batches prepared ahead of training (default: 2)", type=int, default=2)
+    parser.add_argument("--shards", help="load images from the shards made by make_shards.py", action="store_true")
+    parser.add_argument("--loader_processes", help="set the number of sample worker processes, 0 means using threads (default: 0)", type=int, default=0)
+    parser.add_argument("--log_interval", help="set the number of batches between two loss reports, losses stay on device in between (default: 10)", type=int, default=10)
+    parser.add_argument("--checkpoint_interval", help="set the number of batches between two resumable checkpoints, 0 means only at the end of epochs (default: 50)", type=int, default=50)
     parser.add_argument("--device_id", help="select device that the model using (default: 0)", type=int, default=0)
+    parser.add_argument("--device_ids", help="select devices for data-parallel training, e.g. 0,1 (overrides --device_id)", type=str, default="")
+    parser.add_argument("--kvstore", help="set the kvstore that aggregates gradients across devices, dist_sync for distributed training launched by launch.py (default: device)", type=str, default="device")
+    parser.add_argument("--nan_retries", help="set the number of times training is resumed with new random seeds after the loss becomes NaN (default: 5)", type=int, default=5)
+    parser.add_argument("--metrics", help="append per-step phase timings and memory usage to this JSONL file, phases are synchronized so training runs slower", type=str, default=None)
+    parser.add_argument("--profile_steps", help="trace the steps START:END of this run with mx.profiler, e.g. 20:30", type=step_range, default=None)
+    parser.add_argument("--profile_file", help="set the chrome://tracing file written by --profile_steps (default: profile.json)", type=str, default="profile.json")
     parser.add_argument("--gpu", help="using gpu acceleration", action="store_true")
     args = parser.parse_args()
 
+    device_ids = [int(i) for i in args.device_ids.split(",")] if args.device_ids else [args.device_id]
     if args.gpu:
-        context = mx.gpu(args.device_id)
+        context = [mx.gpu(i) for i in device_ids]
+    else:
+        context = [mx.cpu(i) for i in device_ids]
+
+    if args.kvstore.startswith("dist"):
+        kvstore = mx.kv.create(args.kvstore)
     else:
-        context = mx.cpu(args.device_id)
+        kvstore = args.kvstore
 
+    retries = 0
     while True:
+        resumed = checkpoint_position(args.dataset)
         try:
             train(
                 dataset = args.dataset,
@@ -229,8 +512,25 @@ if __name__ == "__main__":
                 lmda_cyc = args.lmda_cyc,
                 lmda_idt = args.lmda_idt,
                 pool_size = 50,
-                context = context
+                prefetch = args.prefetch,
+                shards = args.shards,
+                loader_processes = args.loader_processes,
+                log_interval = args.log_interval,
+                checkpoint_interval = args.checkpoint_interval,
+                context = context,
+                kvstore = kvstore,
+                reseed = retries > 0,
+                metrics = args.metrics,
+                profile_steps = args.profile_steps,
+                profile_file = args.profile_file
             )
             break;
         except ValueError:
             print("Oops! The value of loss become NaN...")
+            if isinstance(kvstore, mx.kv.KVStore):
+                sys.exit("Distributed training can't be retried by one worker alone, resume it by restarting all workers.")
+            if checkpoint_position(args.dataset) != resumed:
+                retries = 0
+            retries += 1
+            if retries > args.nan_retries:
+                sys.exit("Giving up after %d retries." % args.nan_retries)
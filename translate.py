@@ -0,0 +1,171 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import mxnet as mx
+from dataset import preprocess
+from image_codec import formats, encode
+from inference import load_generator, generate
+
+image_exts = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+def walk(inputs, output, fmt):
+    for src in inputs:
+        if os.path.isdir(src):
+            files = sorted(os.path.join(path, f) for path, _, files in os.walk(src) for f in files)
+            root = src
+        else:
+            files = [src]
+            root = os.path.dirname(src)
+        for path in files:
+            if path.lower().endswith(image_exts):
+                yield path, os.path.join(output, os.path.splitext(os.path.relpath(path, root))[0] + formats[fmt][1])
+
+
+def translate(inputs, output, model, is_reversed, size, batch_size, fmt, quality, exported, workers, context):
+    sources = {}
+    for src, dst in walk(inputs, output, fmt):
+        if dst in sources and sources[dst] != src:
+            raise ValueError("%s and %s would both be written to %s" % (sources[dst], src, dst))
+        sources[dst] = src
+    tasks = [(src, dst) for dst, src in sources.items() if not os.path.exists(dst)]
+    print("%d images to translate" % len(tasks), flush=True)
+    if not tasks:
+        return
+
+    print("Loading model...", flush=True)
+    net = load_generator(model, "ba" if is_reversed else "ab", context, exported)
+
+    paths = queue.Queue()
+    for task in tasks:
+        paths.put(task)
+    for _ in range(workers):
+        paths.put(None)
+    reals = queue.Queue(batch_size * 4)
+    fakes = queue.Queue(batch_size * 4)
+
+    def decode():
+        try:
+            while True:
+                task = paths.get()
+                if task is None:
+                    break
+                src, dst = task
+                try:
+                    with open(src, "rb") as f:
+                        img = preprocess(f.read(), size)
+                except Exception as e:
+                    print("Skip %s: %s" % (src, e), flush=True)
+                    continue
+                reals.put((dst, img))
+        finally:
+            reals.put(None)
+
+    def write():
+        while True:
+            item = fakes.get()
+            if item is None:
+                break
+            dst, img = item
+            try:
+                os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+                with open(dst + ".tmp", "wb") as f:
+                    f.write(encode(img, fmt, quality))
+                os.replace(dst + ".tmp", dst)
+            except Exception as e:
+                print("Failed to write %s: %s" % (dst, e), flush=True)
+                if os.path.exists(dst + ".tmp"):
+                    os.remove(dst + ".tmp")
+
+    decoders = [threading.Thread(target=decode, daemon=True) for _ in range(workers)]
+    writers = [threading.Thread(target=write, daemon=True) for _ in range(workers)]
+    for t in decoders + writers:
+        t.start()
+
+    def infer(group):
+        for (dst, _), img in zip(group, generate(net, context, np.stack([x for _, x in group]))):
+            fakes.put((dst, img))
+
+    ts = time.time()
+    done = 0
+    groups = {}
+    pending = 0
+    running = workers
+    while running > 0:
+        item = reals.get()
+        if item is None:
+            running -= 1
+            continue
+        groups.setdefault(item[1].shape, []).append(item)
+        pending += 1
+        shape = max(groups, key=lambda k: len(groups[k]))
+        if len(groups[shape]) >= batch_size or pending >= batch_size * 2:
+            group = groups.pop(shape)
+            infer(group)
+            done += len(group)
+            pending -= len(group)
+            print("%d/%d images  %.2f images/s" % (done, len(tasks), done / (time.time() - ts)), flush=True)
+    for group in groups.values():
+        infer(group)
+        done += len(group)
+    for _ in writers:
+        fakes.put(None)
+    for t in writers:
+        t.join()
+    print("%d/%d images  %.2f images/s  duration %.2fs" % (done, len(tasks), done / (time.time() - ts), time.time() - ts), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Translate images in bulk with a cycle_gan generator.")
+    parser.add_argument("inputs", metavar="PATH", help="path of the image file[s] or director[y|ies]", type=str, nargs="+")
+    parser.add_argument("--output", help="set the output directory (default: output)", type=str, default="output")
+    parser.add_argument("--reversed", help="reverse transformation", action="store_true")
+    parser.add_argument("--model", help="set the model used by the translator (default: vangogh2photo)", type=str, default="vangogh2photo")
+    parser.add_argument("--exported", help="load the generator exported by export.py", action="store_true")
+    parser.add_argument("--resize", help="set the short size of fake image (default: 256)", type=int, default=256)
+    parser.add_argument("--batch_size", help="set the batch size (default: 8)", type=int, default=8)
+    parser.add_argument("--format", help="set the output format (default: png)", type=str, choices=sorted(formats), default="png")
+    parser.add_argument("--quality", help="set the quality of jpeg/webp output (default: 90)", type=int, default=90)
+    parser.add_argument("--workers", help="set the number of decoding/encoding threads (default: 4)", type=int, default=4)
+    parser.add_argument("--device_id", help="select device that the model using (default: 0)", type=int, default=0)
+    parser.add_argument("--gpu", help="using gpu acceleration", action="store_true")
+    args = parser.parse_args()
+
+    if args.gpu:
+        context = mx.gpu(args.device_id)
+    else:
+        context = mx.cpu(args.device_id)
+
+    translate(
+        inputs = args.inputs,
+        output = args.output,
+        model = args.model,
+        is_reversed = args.reversed,
+        size = args.resize,
+        batch_size = args.batch_size,
+        fmt = args.format,
+        quality = args.quality,
+        exported = args.exported,
+        workers = args.workers,
+        context = context
+    )
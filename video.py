@@ -0,0 +1,119 @@
+# Copyright (c) 2018-2021, RangerUFO
+#
+# This file is part of cycle_gan.
+#
+# cycle_gan is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cycle_gan is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+import queue
+import argparse
+import threading
+import cv2
+from dataset import resize_short
+
+def translate_video(src, dst, submit, size, depth=32, fourcc="mp4v", log_interval=0):
+    cap = cv2.VideoCapture(src)
+    if not cap.isOpened():
+        raise ValueError("Failed to open video %s" % src)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    pending = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read():
+        try:
+            while not stop.is_set():
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                put(submit(resize_short(frame, size)))
+        except Exception as e:
+            put(e)
+        finally:
+            cap.release()
+            put(None)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    writer = None
+    frames = 0
+    ts = time.time()
+    try:
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            fake = item.result()
+            if writer is None:
+                writer = cv2.VideoWriter(dst, cv2.VideoWriter_fourcc(*fourcc), fps, (fake.shape[1], fake.shape[0]))
+                if not writer.isOpened():
+                    raise ValueError("Failed to open %s with fourcc %s" % (dst, fourcc))
+            writer.write(cv2.cvtColor(fake, cv2.COLOR_RGB2BGR))
+            frames += 1
+            if log_interval > 0 and frames % log_interval == 0:
+                print("%d/%d frames  %.2f frames/s" % (frames, total, frames / (time.time() - ts)), flush=True)
+    finally:
+        stop.set()
+        reader.join()
+        if writer is not None:
+            writer.release()
+    if frames == 0:
+        raise ValueError("No frames decoded from %s" % src)
+    return frames, time.time() - ts
+
+
+if __name__ == "__main__":
+    import mxnet as mx
+    from concurrent.futures import ThreadPoolExecutor
+    from batcher import Batcher
+    from inference import load_generator, generate
+
+    parser = argparse.ArgumentParser(description="Translate a video with a cycle_gan generator.")
+    parser.add_argument("input", metavar="VIDEO", help="path of the video file", type=str)
+    parser.add_argument("--output", help="set the output video file (default: output.mp4)", type=str, default="output.mp4")
+    parser.add_argument("--fourcc", help="set the fourcc of the output codec (default: mp4v)", type=str, default="mp4v")
+    parser.add_argument("--reversed", help="reverse transformation", action="store_true")
+    parser.add_argument("--model", help="set the model used by the translator (default: vangogh2photo)", type=str, default="vangogh2photo")
+    parser.add_argument("--exported", help="load the generator exported by export.py", action="store_true")
+    parser.add_argument("--resize", help="set the short size of fake frames (default: 256)", type=int, default=256)
+    parser.add_argument("--batch_size", help="set the batch size (default: 8)", type=int, default=8)
+    parser.add_argument("--depth", help="set the max number of frames in flight between decoding and encoding (default: 32)", type=int, default=32)
+    parser.add_argument("--log_interval", help="set the number of frames between two progress reports (default: 100)", type=int, default=100)
+    parser.add_argument("--device_id", help="select device that the model using (default: 0)", type=int, default=0)
+    parser.add_argument("--gpu", help="using gpu acceleration", action="store_true")
+    args = parser.parse_args()
+
+    if args.gpu:
+        context = mx.gpu(args.device_id)
+    else:
+        context = mx.cpu(args.device_id)
+
+    print("Loading model...", flush=True)
+    net = load_generator(args.model, "ba" if args.reversed else "ab", context, args.exported)
+    with ThreadPoolExecutor(1) as worker:
+        batcher = Batcher(lambda batch: worker.submit(generate, net, context, batch), args.batch_size, 0.05)
+        frames, elapsed = translate_video(args.input, args.output, batcher.submit, args.resize, max(args.depth, args.batch_size), args.fourcc, args.log_interval)
+        batcher.close()
+    print("%d frames  %.2f frames/s  duration %.2fs" % (frames, frames / elapsed, elapsed), flush=True)
@@ -16,58 +16,143 @@
 # along with cycle_gan.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import os
 import re
+import sys
+import array
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 
+batch_regex = re.compile("^\[Epoch ([0-9]+)  Batch ([0-9]+)\]  dis_a_loss (\S+)  dis_b_loss (\S+)  gen_loss (\S+)")
+epoch_regex = re.compile("^\[Epoch ([0-9]+)\]  training_dis_a_loss (\S+)  training_dis_b_loss (\S+)  training_gen_loss (\S+)")
 
-def visualize(lines):
-    regex = re.compile("^\[Epoch ([0-9]+)  Batch ([0-9]+)\]  dis_a_loss (\S+)  dis_b_loss (\S+)  gen_loss (\S+)")
-    batch_x = []
-    batch_dis_a_loss = []
-    batch_dis_b_loss = []
-    batch_gen_loss = []
-    for line in lines:
-        m = regex.match(line)
-        if m:
-            batch_x.append((int(m.group(1)), int(m.group(2))))
-            batch_dis_a_loss.append(float(m.group(3)))
-            batch_dis_b_loss.append(float(m.group(4)))
-            batch_gen_loss.append(float(m.group(5)))
-    batches = max(batch_x, key=lambda x: x[1])[1]
-    batch_x = [epoch + batch / batches for epoch, batch in batch_x]
-    regex = re.compile("^\[Epoch ([0-9]+)\]  training_dis_a_loss (\S+)  training_dis_b_loss (\S+)  training_gen_loss (\S+)")
-    epoch_x = []
-    training_dis_a_loss = []
-    training_dis_b_loss = []
-    training_gen_loss = []
-    for line in lines:
-        m = regex.match(line)
+
+class LossLog:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.batches = [array.array("d") for _ in range(5)]
+        self.epochs = [array.array("d") for _ in range(4)]
+        self.offset = 0
+        self.head = b""
+
+    def feed(self, line):
+        if not line.startswith("[Epoch "):
+            return False
+        m = batch_regex.match(line)
         if m:
-            epoch_x.append(int(m.group(1)))
-            training_dis_a_loss.append(float(m.group(2)))
-            training_dis_b_loss.append(float(m.group(3)))
-            training_gen_loss.append(float(m.group(4)))
-    plt.subplot(2, 1, 1)
-    plt.plot(np.array(batch_x), np.array(batch_dis_a_loss), label="batch dis_a loss")
-    plt.plot(np.array(batch_x), np.array(batch_dis_b_loss), label="batch dis_b loss")
-    plt.plot(np.array(batch_x), np.array(batch_gen_loss), label="batch gen loss")
-    plt.grid(True)
-    plt.legend()
-    plt.subplot(2, 1, 2)
-    plt.plot(np.array(epoch_x), np.array(training_dis_a_loss), label="training dis_a loss")
-    plt.plot(np.array(epoch_x), np.array(training_dis_b_loss), label="training dis_b loss")
-    plt.plot(np.array(epoch_x), np.array(training_gen_loss), label="training gen loss")
-    plt.grid(True)
-    plt.legend()
-    plt.show()
+            columns = self.batches
+        else:
+            m = epoch_regex.match(line)
+            if not m:
+                return False
+            columns = self.epochs
+        for column, value in zip(columns, m.groups()):
+            column.append(float(value))
+        return True
+
+    def update(self, path):
+        with open(path, "rb") as f:
+            head = f.read(4096)
+            if not head.startswith(self.head) or os.fstat(f.fileno()).st_size < self.offset:
+                self.reset()
+            self.head = head
+            f.seek(self.offset)
+            changed = False
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self.offset += len(line)
+                changed = self.feed(line.decode(errors="replace")) or changed
+        return changed
+
+    def load(self, path):
+        with np.load(path) as index:
+            self.offset = int(index["offset"])
+            self.head = index["head"].tobytes()
+            self.batches = [self._array(column) for column in index["batches"]]
+            self.epochs = [self._array(column) for column in index["epochs"]]
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f,
+                offset = self.offset,
+                head = np.frombuffer(self.head, dtype=np.uint8),
+                batches = np.array([np.frombuffer(column, dtype=np.float64) for column in self.batches]),
+                epochs = np.array([np.frombuffer(column, dtype=np.float64) for column in self.epochs])
+            )
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _array(values):
+        column = array.array("d")
+        column.frombytes(values.astype(np.float64).tobytes())
+        return column
+
+
+def downsample(x, ys, buckets):
+    if len(x) <= buckets:
+        return x, [(y, y, y) for y in ys]
+    starts = np.linspace(0, len(x), buckets, endpoint=False).astype(int)
+    counts = np.diff(np.append(starts, len(x)))
+    return np.add.reduceat(x, starts) / counts, [(np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts), np.add.reduceat(y, starts) / counts) for y in ys]
+
+
+def visualize(log, axes, buckets):
+    for ax in axes:
+        ax.clear()
+    epoch, batch, dis_a_loss, dis_b_loss, gen_loss = [np.frombuffer(column, dtype=np.float64) for column in log.batches]
+    if len(batch) > 0:
+        batch_x, series = downsample(epoch + batch / batch.max(), [dis_a_loss, dis_b_loss, gen_loss], buckets)
+        for label, (low, high, mean) in zip(["batch dis_a loss", "batch dis_b loss", "batch gen loss"], series):
+            line, = axes[0].plot(batch_x, mean, label=label)
+            if len(batch_x) < len(batch):
+                axes[0].fill_between(batch_x, low, high, color=line.get_color(), alpha=0.3, linewidth=0)
+    axes[0].grid(True)
+    axes[0].legend()
+    epoch_x, training_dis_a_loss, training_dis_b_loss, training_gen_loss = [np.frombuffer(column, dtype=np.float64) for column in log.epochs]
+    axes[1].plot(epoch_x, training_dis_a_loss, label="training dis_a loss")
+    axes[1].plot(epoch_x, training_dis_b_loss, label="training dis_b loss")
+    axes[1].plot(epoch_x, training_gen_loss, label="training gen loss")
+    axes[1].grid(True)
+    axes[1].legend()
 
 
 if __name__ == "__main__":
-    lines = []
-    while True:
-        try:
-            lines.append(input())
-        except EOFError:
-            break
-    visualize(lines)
+    parser = argparse.ArgumentParser(description="Plot the losses in the log of train.py.")
+    parser.add_argument("log", metavar="LOG", help="path of the log file, read from stdin if omitted", nargs="?")
+    parser.add_argument("--follow", help="keep reading the lines appended to the log and refresh the plot", action="store_true")
+    parser.add_argument("--interval", help="set the refresh interval in seconds of --follow (default: 5)", type=float, default=5)
+    parser.add_argument("--buckets", help="set the max number of points of the batch losses, longer series are downsampled into min/max/mean buckets (default: 2000)", type=int, default=2000)
+    parser.add_argument("--index", help="set the path of the parsed index which lets reopening only parse appended lines (default: LOG.idx)", type=str, default=None)
+    parser.add_argument("--no_index", help="parse the whole log without reading or writing the index", action="store_true")
+    args = parser.parse_args()
+
+    log = LossLog()
+    index = None
+    if args.log is None:
+        if args.follow:
+            parser.error("--follow needs a log file")
+        for line in sys.stdin:
+            log.feed(line)
+    else:
+        if not args.no_index:
+            index = args.index or args.log + ".idx"
+            if os.path.isfile(index):
+                log.load(index)
+        if log.update(args.log) and index:
+            log.save(index)
+
+    fig, axes = plt.subplots(2, 1)
+    visualize(log, axes, args.buckets)
+    if not args.follow:
+        plt.show()
+    else:
+        while plt.fignum_exists(fig.number):
+            plt.pause(args.interval)
+            if log.update(args.log):
+                if index:
+                    log.save(index)
+                visualize(log, axes, args.buckets)